@@ -0,0 +1,256 @@
+#Pythonコード
+# 取得したレースデータから、競馬場・コースごとの傾向（枠順・脚質・上がり）を集計する
+import csv
+import sys
+
+try:
+    import numpy as np
+except ImportError: # 集計にはnumpyが必要
+    np = None
+
+CSV_FILE = "./v25y0005_data02.csv" # 集計するデータ（keiba_scraping.pyの出力ファイル）
+
+# 脚質の分類（最初のコーナーの位置を出走頭数で割った値の上限。1番手は逃げ）
+RUNNING_STYLES = ["逃げ", "先行", "差し", "追込"]
+FRONT_RATIO = 1 / 3 # この割合以内なら先行
+MIDDLE_RATIO = 2 / 3 # この割合以内なら差し、超えたら追込
+MAX_CORNERS = 4 # 通過順として保持するコーナーの数
+
+QUANTILES = (0.25, 0.5, 0.75)
+
+def _to_float(values):
+    """文字列のリストを浮動小数点数の配列にする（空文字や "中止" などはNaN）"""
+    result = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+        try:
+            result[i] = float(value)
+        except ValueError:
+            pass
+    return result
+
+def _map_unique(values, func):
+    """値の種類ごとに1回だけfuncを適用し、その結果を列全体に当てはめる"""
+    unique_values, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return func(unique_values.tolist())[inverse]
+
+def parse_passing_orders(values):
+    """
+    通過順の文字列（"'7-8" や "3-3-2-1"）を、コーナーごとの位置の配列（行数 × MAX_CORNERS、ない位置はNaN）にする
+
+    通過順の種類は行数に比べて少ないため、異なる文字列ごとに1回だけ解析する。
+    """
+    def parse(unique_values):
+        positions = np.full((len(unique_values), MAX_CORNERS), np.nan)
+        for i, value in enumerate(unique_values):
+            for j, part in enumerate(value.lstrip("'").split("-")[:MAX_CORNERS]):
+                if part.isdigit():
+                    positions[i, j] = int(part)
+        return positions
+    return _map_unique(values, parse)
+
+def _group(keys):
+    """キーの配列（列のタプル）ごとに (グループのキーのリスト, 各行のグループ番号) を返す"""
+    if len(keys) == 1:
+        unique_values, inverse = np.unique(keys[0], return_inverse=True)
+        return [(value,) for value in unique_values.tolist()], inverse
+    combined = np.rec.fromarrays(keys)
+    unique_values, inverse = np.unique(combined, return_inverse=True)
+    return [tuple(value) for value in unique_values.tolist()], inverse
+
+def _rate(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.zeros(len(denominator)), where=denominator > 0)
+
+class RaceDataset:
+    """
+    取得したレースデータを列ごとのNumPy配列で持ち、競馬場・コースごとの傾向を集計する
+
+    通過順は読み込み時に1回だけコーナーごとの位置の配列に変換し、出走頭数・脚質もまとめて求めておく。
+    集計は行ごとのループではなく、グループ番号に対するbincountなどの配列演算で行う。
+    条件（場所・距離・芝・ダート・馬場・期間）ごとの行の選択と集計結果は保持しておき、同じ条件の集計は計算し直さない。
+    条件を指定するキーワード引数は filter_mask() を参照。
+    """
+
+    def __init__(self, rows):
+        if np is None:
+            raise ImportError("numpy is required for keiba_analytics (pip install numpy)")
+        rows = list(rows)
+        column = lambda name: [row.get(name, "") for row in rows]
+        self.size = len(rows)
+        self.race_id = np.array(column("race_id"), dtype=str)
+        self.place_id = np.array(column("場id"), dtype=str)
+        self.place_name = np.array(column("場名"), dtype=str)
+        self.surface = np.array(column("芝・ダート"), dtype=str)
+        self.going = np.array(column("馬場"), dtype=str)
+        self.date = np.array(column("日付"), dtype=str)
+        self.distance = _map_unique(column("距離"), lambda values: _to_float(values))
+        self.rank = _map_unique(column("着順"), lambda values: _to_float(values))
+        self.gate = _map_unique(column("枠番"), lambda values: _to_float(values))
+        self.number = _map_unique(column("馬番"), lambda values: _to_float(values))
+        self.agari = _map_unique(column("上がり"), lambda values: _to_float(values))
+        self.positions = parse_passing_orders(column("通過順"))
+
+        # 出走頭数（同じrace_idの行数）と、最初のコーナーの位置による脚質
+        _, race_index, field_sizes = np.unique(self.race_id, return_inverse=True, return_counts=True)
+        self.field_size = field_sizes[race_index]
+        first_corner = self.positions[:, 0]
+        ratio = first_corner / self.field_size
+        style = np.full(self.size, -1)
+        style[ratio <= 1] = 3
+        style[ratio <= MIDDLE_RATIO] = 2
+        style[ratio <= FRONT_RATIO] = 1
+        style[first_corner == 1] = 0
+        self.style = style # RUNNING_STYLESの番号（通過順がなければ-1）
+
+        self.win = self.rank == 1
+        self.place = (self.rank >= 1) & (self.rank <= 3)
+        self.finished = ~np.isnan(self.rank) # 中止・除外などは集計に含めない
+        self._masks = {}
+        self._results = {}
+
+    @classmethod
+    def from_csv(cls, csv_path=CSV_FILE):
+        """keiba_scraping.pyが出力したCSVを読み込む"""
+        with open(csv_path, encoding="utf-8-sig", newline="") as f:
+            return cls(csv.DictReader(f))
+
+    def filter_mask(self, place=None, distance=None, surface=None, going=None, date_from=None, date_to=None):
+        """
+        条件に合う行の真偽値の配列（条件ごとに保持する）
+
+        Args:
+            place: 場名（例: "東京"）または場id（例: "05"）。Noneなら全場
+            distance: 距離（例: 1600）。Noneなら全距離
+            surface: 芝・ダート（"芝"/"ダ" または "1"/"0"）。Noneなら両方
+            going: 馬場（例: "良"）。Noneなら全て
+            date_from, date_to: 期間（"YYYY-MM-DD"）。日付のない行は期間を指定すると含まれない
+        """
+        key = (place, None if distance is None else float(distance), {"芝": "1", "ダ": "0"}.get(surface, surface),
+               going, date_from, date_to)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = self.finished.copy()
+            if place is not None:
+                mask &= (self.place_name == place) | (self.place_id == place)
+            if key[1] is not None:
+                mask &= self.distance == key[1]
+            if key[2] is not None:
+                mask &= self.surface == key[2]
+            if going is not None:
+                mask &= self.going == going
+            if date_from is not None:
+                mask &= (self.date != "") & (self.date >= date_from)
+            if date_to is not None:
+                mask &= (self.date != "") & (self.date <= date_to)
+            self._masks[key] = mask
+        return mask
+
+    def _cached(self, name, conditions, compute):
+        key = (name, tuple(sorted(conditions.items())))
+        if key not in self._results:
+            self._results[key] = compute(self.filter_mask(**conditions))
+        return self._results[key]
+
+    def _rates_by(self, values, mask):
+        """valuesの値ごとの出走数・1着・3着以内の回数と勝率・複勝率"""
+        groups, inverse = _group((values[mask],))
+        runs = np.bincount(inverse, minlength=len(groups))
+        wins = np.bincount(inverse, weights=self.win[mask], minlength=len(groups))
+        places = np.bincount(inverse, weights=self.place[mask], minlength=len(groups))
+        win_rate, place_rate = _rate(wins, runs), _rate(places, runs)
+        return {
+            group[0]: {"出走数": int(runs[i]), "勝利数": int(wins[i]), "複勝数": int(places[i]),
+                       "勝率": float(win_rate[i]), "複勝率": float(place_rate[i])}
+            for i, group in enumerate(groups)
+        }
+
+    def gate_stats(self, by="枠番", **conditions):
+        """枠番（by="馬番"なら馬番）ごとの勝率・複勝率"""
+        values = {"枠番": self.gate, "馬番": self.number}[by]
+
+        def compute(mask):
+            mask = mask & ~np.isnan(values)
+            return {int(key): stats for key, stats in self._rates_by(values, mask).items()}
+        return self._cached(f"gate_stats:{by}", conditions, compute)
+
+    def running_style_stats(self, **conditions):
+        """脚質（最初のコーナーの位置で分類）ごとの勝率・複勝率"""
+        def compute(mask):
+            mask = mask & (self.style >= 0)
+            return {RUNNING_STYLES[key]: stats for key, stats in self._rates_by(self.style, mask).items()}
+        return self._cached("running_style_stats", conditions, compute)
+
+    def agari_distribution(self, by=("馬場", "距離"), **conditions):
+        """
+        上がりの分布（件数・平均・標準偏差・最小・四分位・最大）を by の列の組み合わせごとに返す
+
+        byには "場名"・"場id"・"芝・ダート"・"馬場"・"距離" を指定できる。
+        """
+        columns = {"場名": self.place_name, "場id": self.place_id, "芝・ダート": self.surface,
+                   "馬場": self.going, "距離": self.distance}
+
+        def compute(mask):
+            mask = mask & ~np.isnan(self.agari)
+            if "距離" in by: # 距離のない行（レース情報の詳細がなかったレース）はグループにできない
+                mask &= ~np.isnan(self.distance)
+            groups, inverse = _group(tuple(columns[name][mask] for name in by))
+            values = self.agari[mask]
+            counts = np.bincount(inverse, minlength=len(groups))
+            sums = np.bincount(inverse, weights=values, minlength=len(groups))
+            squares = np.bincount(inverse, weights=values ** 2, minlength=len(groups))
+            means = _rate(sums, counts)
+            stds = np.sqrt(np.maximum(_rate(squares, counts) - means ** 2, 0))
+            # グループ番号・値の順に並べ、各グループの先頭からの位置で分位数を求める
+            sorted_values = values[np.lexsort((values, inverse))]
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            quantiles = {q: sorted_values[starts + np.floor(q * (counts - 1)).astype(int)] for q in QUANTILES}
+            result = {}
+            for i, group in enumerate(groups):
+                key = tuple(int(v) if name == "距離" else v for name, v in zip(by, group))
+                result[key if len(key) > 1 else key[0]] = {
+                    "件数": int(counts[i]), "平均": float(means[i]), "標準偏差": float(stds[i]),
+                    "最小": float(sorted_values[starts[i]]),
+                    **{f"{int(q * 100)}%": float(quantiles[q][i]) for q in QUANTILES},
+                    "最大": float(sorted_values[starts[i] + counts[i] - 1]),
+                }
+            return result
+        return self._cached(f"agari_distribution:{','.join(by)}", conditions, compute)
+
+    def courses(self):
+        """データに含まれる (場id, 場名, 芝・ダート, 距離) の組み合わせを出走数の多い順に返す"""
+        mask = self.finished & ~np.isnan(self.distance)
+        groups, inverse = _group((self.place_id[mask], self.place_name[mask], self.surface[mask], self.distance[mask]))
+        counts = np.bincount(inverse, minlength=len(groups))
+        order = np.argsort(-counts, kind="stable")
+        return [(groups[i][0], groups[i][1], groups[i][2], int(groups[i][3]), int(counts[i])) for i in order]
+
+    def course_bias_report(self, **conditions):
+        """枠番・馬番・脚質ごとの成績と、馬場・距離ごとの上がりの分布をまとめて返す"""
+        return {
+            "枠番": self.gate_stats("枠番", **conditions),
+            "馬番": self.gate_stats("馬番", **conditions),
+            "脚質": self.running_style_stats(**conditions),
+            "上がり": self.agari_distribution(**conditions),
+        }
+
+def print_report(report):
+    for title in ("枠番", "馬番", "脚質"):
+        print(f"  [{title}]")
+        for key, stats in report[title].items():
+            print(f"    {key}: 出走 {stats['出走数']}, 勝率 {stats['勝率']:.1%}, 複勝率 {stats['複勝率']:.1%}")
+    print("  [上がり (馬場, 距離)]")
+    for key, stats in report["上がり"].items():
+        print(f"    {key}: {stats['件数']}件, 平均 {stats['平均']:.2f}, 中央値 {stats['50%']:.1f}, "
+              f"範囲 {stats['最小']:.1f}-{stats['最大']:.1f}")
+
+def main():
+    """メイン処理: CSVを読み込み、出走数の多いコースから順に傾向を表示する"""
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else CSV_FILE
+    dataset = RaceDataset.from_csv(csv_path)
+    print(f"[INFO] Loaded {dataset.size} rows from {csv_path}")
+    surfaces = {"1": "芝", "0": "ダ"}
+    for place_id, place_name, surface, distance, runs in dataset.courses():
+        print(f"[{place_name or place_id} {surfaces.get(surface, surface)}{distance}m] {runs} runs")
+        print_report(dataset.course_bias_report(place=place_id, distance=distance, surface=surface))
+
+if __name__ == "__main__":
+    main()
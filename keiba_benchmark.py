@@ -0,0 +1,353 @@
+#Pythonコード
+# keiba_scraping.py の処理性能を計測するベンチマーク（netkeiba.comにはアクセスしない）
+import contextlib
+import csv
+import gc
+import html
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import keiba_scraping as ks
+
+SAMPLE_CSV = "./v25y0005_data02.csv" # 計測用のデータ（取得済みのデータを元に戻して使う）
+FIXTURE_DIR = "./tests/fixtures/pages/" # 記録したレースページ（<race_id>.html。record_fixture_pagesで作成する）
+
+# === ローカルサーバーの設定 ===
+SERVER_LATENCY = 0.05 # 1リクエストごとに待たせる秒数（netkeiba.comの応答時間の代わり）
+SERVER_ERROR_RATE = 0.05 # 503を返すリクエストの割合（再試行の処理も含めて計測する）
+MISSING_RACE_RATE = 0.2 # 取得するrace_idのうち、存在しないレースのページを返すものの割合
+FIXTURE_LIMIT = 500 # 計測に使うレースページの数の上限
+
+def load_sample_rows(csv_path=SAMPLE_CSV):
+    """取得済みのCSVを読み込み、clean_data前（get_race_dataの戻り値と同じ形）の行に戻す"""
+    to_surface = {"1": "芝", "0": "ダ"}
+    to_turn = {"1": "右", "0": "左"}
+    to_sex = {"1": "牡", "0": "牝"}
+    to_weather = {"1": "天候 : 晴", "0": "天候 : 曇", "-1": "天候 : 雨"}
+    rows = []
+    with open(csv_path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            race_time = row["走破時間"]
+            if race_time:
+                minutes, seconds = divmod(float(race_time), 60)
+                race_time = f"{int(minutes)}:{seconds:04.1f}"
+            row.update({
+                "走破時間": race_time,
+                "通過順": row["通過順"].lstrip("'"),
+                "芝・ダート": to_surface.get(row["芝・ダート"], row["芝・ダート"]),
+                "回り": to_turn.get(row["回り"], row["回り"]),
+                "性": to_sex.get(row["性"], row["性"]),
+                "天気": to_weather.get(row["天気"], row["天気"]),
+            })
+            rows.append(row)
+    return rows
+
+def bench_clean_data(rows, repeat=5):
+    """
+    clean_dataとclean_data_batchの処理時間を計測する
+
+    結果が一致することの確認は tests/test_clean_data.py で行う。
+    """
+    results = {}
+    for name, func in (("clean_data", ks.clean_data), ("clean_data_batch", ks.clean_data_batch)):
+        results[name] = best = _best_time(func, rows, repeat=repeat)
+        print(f"[INFO] {name}: {best * 1000:.1f} ms for {len(rows)} rows ({len(rows) / best:,.0f} rows/sec)")
+    print(f"[INFO] clean_data_batch speedup: {results['clean_data'] / results['clean_data_batch']:.1f}x")
+    return results
+
+def _html_text(value):
+    """HTMLのテキストにする（EUC-JPにないNBSPは実際のページと同じく&nbsp;で書く）"""
+    return html.escape(value).replace("\xa0", "&nbsp;")
+
+def synthetic_race_page(rows):
+    """
+    clean_data前の1レース分の行から、netkeiba.comのレースページと同じ構造のHTML（EUC-JP）を作る
+
+    EUC-JPで表せない文字を含む場合はUnicodeEncodeErrorになる（"?"に置き換えて解析結果が変わらないようにする）。
+    """
+    first = rows[0]
+    cells = []
+    for row in rows:
+        weight = f"{row['体重']}({row['体重変化']})" if row["体重変化"] else row["体重"]
+        values = [
+            _html_text(row["着順"]), f"<span>{_html_text(row['枠番'])}</span>", _html_text(row["馬番"]),
+            f'<a href="/horse/">{_html_text(row["馬"])}</a>', _html_text(row["性"] + row["齢"]), _html_text(row["斤量"]),
+            f'<a href="/jockey/">{_html_text(row["騎手"])}</a>', _html_text(row["走破時間"]),
+            "", "**", _html_text(row["通過順"]), _html_text(row["上がり"]), _html_text(row["オッズ"]), _html_text(row["人気"]),
+            _html_text(weight), "", "", "", "", "", "",
+        ]
+        cells.append("<tr>" + "".join(f"<td>{value}</td>" for value in values) + "</tr>")
+    details = "&nbsp;/&nbsp;".join([
+        _html_text(f"{first['芝・ダート']}{first['回り']}{first['距離']}m"), _html_text(first["天気"]), "発走 : 12:10",
+    ])
+    page = f"""<html><head><meta http-equiv="Content-Type" content="text/html; charset=EUC-JP"></head><body>
+<div class="data_intro"><dl class="racedata fc"><dd><h1>{_html_text(first['レース名'])}</h1>
+<p><diary_snap_cut><span>{details}</span></diary_snap_cut></p></dd></dl></div>
+<table class="race_table_01 nk_tb_common"><tr><th>着順</th></tr>
+{"".join(cells)}
+</table></body></html>"""
+    return page.encode("euc-jp")
+
+def missing_race_page():
+    """存在しないrace_idのページ（レース情報がない）"""
+    return '<html><head><meta charset="EUC-JP"></head><body><div id="page">該当なし</div></body></html>'.encode("euc-jp")
+
+def record_fixture_pages(race_ids, dirpath=FIXTURE_DIR):
+    """
+    レースページを取得したままのHTMLで dirpath/<race_id>.html に保存する（計測用のページの記録）
+
+    HTMLキャッシュにあるページはキャッシュから、ないページはnetkeiba.comから（リクエスト間隔を守って）取得する。
+    """
+    os.makedirs(dirpath, exist_ok=True)
+    cache = ks.get_page_cache()
+    for race_id in race_ids:
+        cached = cache.get(race_id) if cache is not None else None
+        content = cached[0] if cached else ks.fetch_race_page(race_id)
+        if not content or not ks.page_exists(content):
+            print(f"[WARN] Race page not available for race_id: {race_id}")
+            continue
+        with open(os.path.join(dirpath, f"{race_id}.html"), "wb") as f:
+            f.write(content)
+        print(f"[INFO] Recorded {race_id} ({len(content) / 1024:.0f} KB)")
+
+def load_recorded_pages(dirpath=FIXTURE_DIR, limit=FIXTURE_LIMIT):
+    """record_fixture_pagesで記録したレースページを (race_id, HTML) のリストで返す"""
+    if not os.path.isdir(dirpath):
+        return []
+    pages = []
+    for name in sorted(os.listdir(dirpath))[:limit]:
+        race_id, ext = os.path.splitext(name)
+        if ext == ".html":
+            with open(os.path.join(dirpath, name), "rb") as f:
+                pages.append((race_id, f.read()))
+    return pages
+
+def load_fixture_pages(limit=FIXTURE_LIMIT, csv_path=SAMPLE_CSV):
+    """
+    計測に使うレースページを (race_id, HTML) のリストで返す
+
+    記録したページ（FIXTURE_DIR）があればそれを使う。なければHTMLキャッシュ（CACHE_DIR）に取得済みのページ、
+    それもなければサンプルのCSVから作ったページを使う（作ったページは実際のページより単純なため、解析の計測は目安になる）。
+    """
+    pages = load_recorded_pages(limit=limit)
+    if pages:
+        print(f"[INFO] Using {len(pages)} recorded pages from {FIXTURE_DIR}")
+        return pages
+    if ks.CACHE_DIR and os.path.isfile(os.path.join(ks.CACHE_DIR, "index.sqlite")):
+        cache = ks.get_page_cache()
+        pages = [(race_id, cache.get(race_id)) for race_id in cache.race_ids()[:limit]]
+        pages = [(race_id, cached[0]) for race_id, cached in pages if cached]
+        if pages:
+            print(f"[INFO] Using {len(pages)} cached pages from {ks.CACHE_DIR}")
+            return pages
+    races = {}
+    for row in load_sample_rows(csv_path):
+        races.setdefault(row["race_id"], []).append(row)
+    pages = [(race_id, synthetic_race_page(rows)) for race_id, rows in list(races.items())[:limit]]
+    print(f"[INFO] Using {len(pages)} pages generated from {csv_path}")
+    return pages
+
+class FixtureServer:
+    """
+    レースページをURL_BASEと同じ形のパス（/race/<race_id>）で返すローカルHTTPサーバー
+
+    latency秒待ってから応答し、error_rateの割合で503（Retry-After: 0）を返す。
+    pagesにないrace_idには存在しないレースのページを返す。with文で使う。
+    """
+
+    def __init__(self, pages, latency=SERVER_LATENCY, error_rate=SERVER_ERROR_RATE, seed=0):
+        self.pages = dict(pages)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url_base = f"http://127.0.0.1:{self.server.server_address[1]}/race/"
+
+    def _handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-aliveで接続を使い回せるようにする
+
+            def do_GET(self):
+                time.sleep(fixture.latency)
+                with fixture.lock:
+                    fixture.requests += 1
+                    failed = fixture.random.random() < fixture.error_rate
+                    fixture.errors += failed
+                match = re.fullmatch(r"/race/(\d{12})/?", self.path)
+                if failed:
+                    self._send(503, b"Service Unavailable", {"Retry-After": "0"})
+                elif match is None:
+                    self._send(404, b"Not Found")
+                else:
+                    self._send(200, fixture.pages.get(match.group(1)) or missing_race_page(),
+                               {"Content-Type": "text/html; charset=EUC-JP"})
+
+            def _send(self, status, body, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+@contextlib.contextmanager
+def local_site(server, output_dir):
+    """
+    keiba_scraping.py の取得先をローカルサーバーに向け、出力先を output_dir にする
+
+    リクエスト間隔の制限（rate_limited_request）は計測の対象外として止める。ログの出力も止める
+    （解析プロセスにはCrawlPipelineが親プロセスのログの設定を引き継ぐ）。
+    """
+    saved = {name: getattr(ks, name) for name in
+             ("URL_BASE", "CACHE_DIR", "DATABASE_FILE", "FEATURE_STORE_FILE", "REPORT_FILE", "transport",
+              "rate_limited_request")}
+    ks.URL_BASE = server.url_base
+    ks.CACHE_DIR = None
+    ks.DATABASE_FILE = os.path.join(output_dir, "keiba.sqlite")
+    ks.FEATURE_STORE_FILE = os.path.join(output_dir, "keiba_features.sqlite")
+    ks.REPORT_FILE = os.path.join(output_dir, "crawl_report.json")
+    ks.transport = ks.HttpTransport(pool_size=ks.MAX_WORKERS)
+    ks.rate_limited_request = lambda url=None: None
+    logger_disabled = ks.logger.disabled
+    ks.logger.disabled = True
+    try:
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        ks.logger.disabled = logger_disabled
+        for name, value in saved.items():
+            setattr(ks, name, value)
+
+def report(stage, seconds, races, rows=None):
+    """段ごとの処理速度を表示し、結果の辞書を返す"""
+    result = {"seconds": seconds, "races": races, "races_per_sec": races / seconds if seconds else 0.0}
+    line = f"[INFO] {stage}: {seconds:.2f} s, {result['races_per_sec']:,.1f} races/sec"
+    if rows is not None:
+        result["rows"] = rows
+        result["rows_per_sec"] = rows / seconds if seconds else 0.0
+        line += f", {result['rows_per_sec']:,.0f} rows/sec"
+    print(line)
+    return result
+
+def bench_stages(pages, latency=SERVER_LATENCY, error_rate=SERVER_ERROR_RATE):
+    """
+    ローカルサーバーを相手に、取得・解析・クリーニング・書き込みの各段と、パイプライン全体の処理速度を計測する
+
+    Returns:
+        {段の名前: report()の戻り値} の辞書
+    """
+    rng = random.Random(0)
+    missing = [f"{race_id[:10]}{99 - i % 90:02d}" for i, (race_id, _) in enumerate(pages)
+               if rng.random() < MISSING_RACE_RATE]
+    race_ids = [race_id for race_id, _ in pages] + missing
+    results = {}
+    with FixtureServer(pages, latency, error_rate) as server, tempfile.TemporaryDirectory() as output_dir:
+        # --- 取得 ---
+        with local_site(server, output_dir), ThreadPoolExecutor(max_workers=ks.MAX_WORKERS) as pool:
+            start = time.perf_counter()
+            fetched = list(pool.map(ks.fetch_race_page, race_ids))
+            elapsed = time.perf_counter() - start
+        results["fetch"] = report("fetch", elapsed, len(race_ids))
+        print(f"[INFO]   {sum(map(len, fetched)) / 1024 ** 2:.1f} MB, {server.requests} requests "
+              f"({server.errors} injected errors, {len(missing)} missing races)")
+
+        # --- 解析 ---
+        races = []
+        for engine in ks.PARSER_ENGINES:
+            with local_site(server, output_dir):
+                start = time.perf_counter()
+                parsed = [ks._parse_race_page(content, race_id, None, None, engine)[1] for race_id, content in pages]
+                elapsed = time.perf_counter() - start
+            races = [race for race in parsed if race]
+            results[f"parse ({engine})"] = report(f"parse ({engine})", elapsed, len(pages), sum(map(len, races)))
+
+        # --- クリーニング ---
+        rows = [row for race in races for row in race.to_rows()]
+        with local_site(server, output_dir):
+            elapsed = _best_time(ks.clean_data_batch, rows, repeat=3)
+        results["clean"] = report("clean", elapsed, len(races), len(rows))
+
+        # --- 書き込み ---
+        with local_site(server, output_dir):
+            start = time.perf_counter()
+            with ks.RaceWriter(os.path.join(output_dir, "write.csv"), flush_rows=ks.WRITER_FLUSH_ROWS) as writer:
+                for race in races:
+                    writer.write_race(race)
+            elapsed = time.perf_counter() - start
+        results["write"] = report("write", elapsed, len(races), len(rows))
+
+        # --- パイプライン全体（取得・解析・書き込みを並行して行う） ---
+        pipeline_csv = os.path.join(output_dir, "pipeline.csv")
+        with local_site(server, output_dir):
+            start = time.perf_counter()
+            ks.crawl_races(race_ids, pipeline_csv)
+            elapsed = time.perf_counter() - start
+        with open(pipeline_csv, encoding="utf-8-sig", newline="") as f:
+            written_rows = sum(1 for _ in csv.DictReader(f))
+        results["pipeline"] = report("pipeline", elapsed, len(race_ids), written_rows)
+        # パイプラインの中での段ごとの処理時間（crawl_races が保存したレポート）
+        stats = ks.crawl_stats.report()
+        print("[INFO]   " + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in stats["stage_seconds"].items()))
+        print(f"[INFO]   races: {stats['races']}, errors: {stats['errors']}")
+    return results
+
+def _best_time(func, *args, repeat=5):
+    """funcを repeat 回実行した中で最短の処理時間（秒）を返す（timeitと同様に計測中はGCを止める）"""
+    best = float("inf")
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            best = min(best, time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+def main():
+    """
+    メイン処理: サンプルデータを増やしてクリーニングを計測し、ローカルサーバーを相手に各段を計測する
+
+    python keiba_benchmark.py record <race_id>... で、計測に使うレースページをFIXTURE_DIRに記録する。
+    """
+    if sys.argv[1:2] == ["record"]:
+        ks.configure_logging()
+        record_fixture_pages(sys.argv[2:])
+        return
+    rows = load_sample_rows()
+    # 複数年分のデータを想定して行数を増やす
+    rows = rows * 50
+    bench_clean_data(rows)
+    # ローカルサーバーを相手にした段ごとの計測
+    bench_stages(load_fixture_pages())
+
+if __name__ == "__main__":
+    main()
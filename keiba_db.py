@@ -0,0 +1,240 @@
+#Pythonコード
+# 取得したレースデータを保存するSQLiteデータベースと、よく使う検索のための関数
+import csv
+import os
+import sqlite3
+
+# レース単位の列（racesテーブル）と出走馬単位の列（entriesテーブル）
+RACE_COLUMNS = ["レース名", "日付", "開催", "クラス", "芝・ダート", "距離", "回り", "馬場", "天気", "場id", "場名"]
+ENTRY_COLUMNS = ["着順", "枠番", "馬番", "性", "齢", "斤量", "走破時間", "通過順", "上がり", "人気", "オッズ", "体重", "体重変化"]
+
+# 数値の列はINTEGER/REALの型にしておくと、"1" は数値として、"中止" などはそのままの文字列として保存される
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS races (
+    race_id TEXT PRIMARY KEY,
+    "レース名" TEXT,
+    "日付" TEXT,
+    "開催" TEXT,
+    "クラス" TEXT,
+    "芝・ダート" INTEGER,
+    "距離" INTEGER,
+    "回り" INTEGER,
+    "馬場" TEXT,
+    "天気" INTEGER,
+    "場id" TEXT,
+    "場名" TEXT
+);
+CREATE TABLE IF NOT EXISTS horses (
+    horse_id INTEGER PRIMARY KEY,
+    "馬" TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS jockeys (
+    jockey_id INTEGER PRIMARY KEY,
+    "騎手" TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS entries (
+    race_id TEXT NOT NULL REFERENCES races (race_id),
+    horse_id INTEGER REFERENCES horses (horse_id),
+    jockey_id INTEGER REFERENCES jockeys (jockey_id),
+    "着順" INTEGER,
+    "枠番" INTEGER,
+    "馬番" INTEGER,
+    "性" INTEGER,
+    "齢" INTEGER,
+    "斤量" REAL,
+    "走破時間" REAL,
+    "通過順" TEXT,
+    "上がり" REAL,
+    "人気" INTEGER,
+    "オッズ" REAL,
+    "体重" INTEGER,
+    "体重変化" INTEGER
+);
+CREATE INDEX IF NOT EXISTS entries_race_id ON entries (race_id);
+CREATE INDEX IF NOT EXISTS entries_horse_id ON entries (horse_id);
+CREATE INDEX IF NOT EXISTS entries_jockey_id ON entries (jockey_id);
+CREATE INDEX IF NOT EXISTS races_date ON races ("日付");
+CREATE INDEX IF NOT EXISTS races_place ON races ("場id", "距離");
+CREATE INDEX IF NOT EXISTS races_distance ON races ("距離", "芝・ダート");
+"""
+
+def _quote(column):
+    return f'"{column}"'
+
+def _value(value):
+    """空文字はNULLとして保存する"""
+    return None if value == "" else value
+
+def _entry_values(row):
+    values = [_value(row.get(col, "")) for col in ENTRY_COLUMNS]
+    # 通過順はExcelで日付に変換されないよう先頭に付けている ' を外して保存する
+    index = ENTRY_COLUMNS.index("通過順")
+    if values[index]:
+        values[index] = values[index].lstrip("'")
+    return values
+
+class RaceDatabase:
+    """
+    レースデータを正規化して保存するSQLiteデータベース
+
+    レース単位の情報はraces、馬と騎手はhorses・jockeys、出走馬ごとの結果はentriesに分けて保存し、
+    race_id・馬・騎手・日付・場id・距離に索引を付けているため、特定の馬や騎手の成績をファイル全体を読まずに検索できる。
+    insert_racesに渡す行はclean_data後の辞書（CSVに書き出す行と同じ形）。
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(filepath)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def insert_races(self, rows):
+        """
+        行をまとめて1つのトランザクションで保存する
+
+        同じrace_idのレースが既にある場合は置き換えるため、同じ行を何度保存しても重複しない。
+        """
+        if not rows:
+            return
+        race_ids = list(dict.fromkeys(row["race_id"] for row in rows))
+        with self.conn:
+            horse_ids = self._name_ids("horses", "horse_id", "馬", {row.get("馬", "") for row in rows})
+            jockey_ids = self._name_ids("jockeys", "jockey_id", "騎手", {row.get("騎手", "") for row in rows})
+
+            self.conn.executemany("DELETE FROM entries WHERE race_id = ?", [(race_id,) for race_id in race_ids])
+            race_rows = {}
+            for row in rows:
+                race_rows.setdefault(row["race_id"], [row["race_id"]] + [_value(row.get(col, "")) for col in RACE_COLUMNS])
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO races (race_id, {', '.join(map(_quote, RACE_COLUMNS))}) "
+                f"VALUES ({', '.join('?' for _ in range(len(RACE_COLUMNS) + 1))})",
+                list(race_rows.values()),
+            )
+            self.conn.executemany(
+                f"INSERT INTO entries (race_id, horse_id, jockey_id, {', '.join(map(_quote, ENTRY_COLUMNS))}) "
+                f"VALUES ({', '.join('?' for _ in range(len(ENTRY_COLUMNS) + 3))})",
+                [
+                    [row["race_id"], horse_ids.get(row.get("馬", "")), jockey_ids.get(row.get("騎手", ""))]
+                    + _entry_values(row)
+                    for row in rows
+                ],
+            )
+
+    def _name_ids(self, table, id_column, name_column, names):
+        """名前のIDを返す（未登録の名前は登録する）。空の名前は含めない"""
+        names = [name for name in names if name]
+        if not names:
+            return {}
+        self.conn.executemany(
+            f"INSERT OR IGNORE INTO {table} ({_quote(name_column)}) VALUES (?)", [(name,) for name in names]
+        )
+        ids = {}
+        # SQLiteのプレースホルダー数の上限を超えないよう分割して問い合わせる
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            query = (f"SELECT {id_column}, {_quote(name_column)} FROM {table} "
+                     f"WHERE {_quote(name_column)} IN ({', '.join('?' for _ in chunk)})")
+            ids.update({name: row_id for row_id, name in self.conn.execute(query, chunk)})
+        return ids
+
+    def import_csv(self, csv_path, batch_size=5000):
+        """append_to_csvで作成したCSVを読み込んで保存する（データベースを使い始める前のデータの取り込み用）"""
+        with open(csv_path, encoding="utf-8-sig", newline="") as f:
+            batch = []
+            for row in csv.DictReader(f):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    self.insert_races(batch)
+                    batch = []
+            self.insert_races(batch)
+
+    # --- 検索 ---
+
+    def _entries(self, where, params, order="r.\"日付\", r.race_id, e.\"馬番\""):
+        query = f"""
+            SELECT r.race_id, {', '.join('r.' + _quote(col) for col in RACE_COLUMNS)},
+                   h."馬", j."騎手", {', '.join('e.' + _quote(col) for col in ENTRY_COLUMNS)}
+            FROM entries e
+            JOIN races r ON r.race_id = e.race_id
+            LEFT JOIN horses h ON h.horse_id = e.horse_id
+            LEFT JOIN jockeys j ON j.jockey_id = e.jockey_id
+            WHERE {where}
+            ORDER BY {order}
+        """
+        return [dict(row) for row in self.conn.execute(query, params)]
+
+    def race_entries(self, race_id):
+        """レースの出走馬の結果を馬番順に返す"""
+        return self._entries("e.race_id = ?", (race_id,), order='e."馬番"')
+
+    def horse_runs(self, horse):
+        """馬の全出走結果を日付順に返す"""
+        return self._entries('e.horse_id = (SELECT horse_id FROM horses WHERE "馬" = ?)', (horse,))
+
+    def jockey_runs(self, jockey, place_id=None, distance=None, surface=None):
+        """
+        騎手の出走結果を日付順に返す
+
+        Args:
+            jockey: 騎手名
+            place_id: 場id（例: "05"）。Noneなら全場
+            distance: 距離（例: 1600）。Noneなら全距離
+            surface: 芝・ダート（"芝"/"ダ" または 1/0）。Noneなら両方
+        """
+        where, params = self._race_conditions(place_id, distance, surface)
+        where.insert(0, 'e.jockey_id = (SELECT jockey_id FROM jockeys WHERE "騎手" = ?)')
+        return self._entries(" AND ".join(where), [jockey] + params)
+
+    def jockey_stats(self, jockey, place_id=None, distance=None, surface=None):
+        """騎手の騎乗数・1着・3着以内の回数と勝率・複勝率を返す（条件はjockey_runsと同じ）"""
+        where, params = self._race_conditions(place_id, distance, surface)
+        where.insert(0, 'e.jockey_id = (SELECT jockey_id FROM jockeys WHERE "騎手" = ?)')
+        row = self.conn.execute(f"""
+            SELECT COUNT(*) AS 騎乗数,
+                   COALESCE(SUM(e."着順" = 1), 0) AS 勝利数,
+                   COALESCE(SUM(e."着順" BETWEEN 1 AND 3), 0) AS 複勝数
+            FROM entries e JOIN races r ON r.race_id = e.race_id
+            WHERE {" AND ".join(where)}
+        """, [jockey] + params).fetchone()
+        stats = dict(row)
+        stats["勝率"] = stats["勝利数"] / stats["騎乗数"] if stats["騎乗数"] else 0.0
+        stats["複勝率"] = stats["複勝数"] / stats["騎乗数"] if stats["騎乗数"] else 0.0
+        return stats
+
+    def races(self, date_from=None, date_to=None, place_id=None, distance=None, surface=None):
+        """条件に合うレースの情報を日付順に返す（日付は "YYYY-MM-DD"）"""
+        where, params = self._race_conditions(place_id, distance, surface)
+        if date_from:
+            where.append('r."日付" >= ?')
+            params.append(date_from)
+        if date_to:
+            where.append('r."日付" <= ?')
+            params.append(date_to)
+        query = f"SELECT * FROM races r WHERE {' AND '.join(where) or '1'} ORDER BY r.\"日付\", r.race_id"
+        return [dict(row) for row in self.conn.execute(query, params)]
+
+    def _race_conditions(self, place_id, distance, surface):
+        where, params = [], []
+        if place_id is not None:
+            where.append('r."場id" = ?')
+            params.append(place_id)
+        if distance is not None:
+            where.append('r."距離" = ?')
+            params.append(int(distance))
+        if surface is not None:
+            where.append('r."芝・ダート" = ?')
+            params.append({"芝": 1, "ダ": 0}.get(surface, surface))
+        return where, params
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,239 @@
+#Pythonコード
+# 馬・騎手ごとの集計（特徴量）を、レースを書き出すたびに差分だけ更新して保存するSQLiteのストア
+import csv
+import json
+import os
+import sqlite3
+
+RECENT_RUNS = 5 # 馬ごとに保持する直近の出走数
+# 直近の出走として保持する列（clean_data後の行の列名）
+RECENT_COLUMNS = ["日付", "race_id", "場名", "芝・ダート", "距離", "馬場", "着順", "走破時間", "上がり", "体重", "体重変化"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folded_races (
+    race_id TEXT PRIMARY KEY,
+    "日付" TEXT
+);
+CREATE TABLE IF NOT EXISTS horse_features (
+    "馬" TEXT PRIMARY KEY,
+    runs INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    top3 INTEGER NOT NULL,
+    first_date TEXT,
+    last_date TEXT,
+    recent TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jockey_features (
+    "騎手" TEXT NOT NULL,
+    "場名" TEXT NOT NULL,
+    "芝・ダート" TEXT NOT NULL,
+    "距離" TEXT NOT NULL,
+    rides INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    top3 INTEGER NOT NULL,
+    last_date TEXT,
+    PRIMARY KEY ("騎手", "場名", "芝・ダート", "距離")
+);
+"""
+
+def _to_number(value, cast):
+    """文字列を数値に変換する。空文字や "中止"・"計不" など変換できない値はNone"""
+    if value is None or value == "":
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        return None
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else None
+
+class FeatureStore:
+    """
+    馬・騎手ごとの集計を保存し、レースが追加されるたびにそのレースの出走馬の分だけ更新するストア
+
+    - 馬: 出走数・1着・3着以内の回数と、日付順で直近 recent_runs 走の結果（走破時間・上がり・体重変化など）
+    - 騎手: 場名・芝・ダート・距離ごとの騎乗数・1着・3着以内の回数
+
+    更新はupdate()に渡した行の出走馬の数に比例した処理だけで済み、CSV全体から集計し直す必要はない。
+    日付の古いレースが後から追加された場合も、直近の出走は日付順に並べ直して保持する。
+    一度取り込んだrace_idは記録しておき、同じレースを何度渡しても二重に数えない。
+    update()に渡す行はclean_data後の辞書（CSVに書き出す行と同じ形）。
+    """
+
+    def __init__(self, filepath, recent_runs=RECENT_RUNS):
+        self.filepath = filepath
+        self.recent_runs = recent_runs
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(filepath)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def update(self, rows):
+        """行をまとめて集計に取り込む（1つのトランザクションで行う）。取り込み済みのレースの行は無視する"""
+        if not rows:
+            return
+        with self.conn:
+            new_race_ids = self._new_races(rows)
+            rows = [row for row in rows if row["race_id"] in new_race_ids]
+            if not rows:
+                return
+            rows.sort(key=lambda row: (row.get("日付", ""), row["race_id"]))
+            self._update_horses(rows)
+            self._update_jockeys(rows)
+
+    def _new_races(self, rows):
+        """まだ取り込んでいないレースを記録し、そのrace_idの集合を返す"""
+        dates = {}
+        for row in rows:
+            dates.setdefault(row["race_id"], row.get("日付", ""))
+        race_ids = list(dates)
+        known = set()
+        for start in range(0, len(race_ids), 500):
+            chunk = race_ids[start:start + 500]
+            query = f"SELECT race_id FROM folded_races WHERE race_id IN ({', '.join('?' for _ in chunk)})"
+            known.update(row[0] for row in self.conn.execute(query, chunk))
+        new_race_ids = [race_id for race_id in race_ids if race_id not in known]
+        self.conn.executemany(
+            'INSERT INTO folded_races (race_id, "日付") VALUES (?, ?)', [(race_id, dates[race_id]) for race_id in new_race_ids]
+        )
+        return set(new_race_ids)
+
+    def _update_horses(self, rows):
+        names = list({row.get("馬", "") for row in rows} - {""})
+        states = {}
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            query = f'SELECT * FROM horse_features WHERE "馬" IN ({", ".join("?" for _ in chunk)})'
+            for row in self.conn.execute(query, chunk):
+                state = dict(row)
+                state["recent"] = json.loads(state["recent"])
+                states[row["馬"]] = state
+
+        for row in rows:
+            name = row.get("馬", "")
+            if not name:
+                continue
+            state = states.setdefault(name, {"馬": name, "runs": 0, "wins": 0, "top3": 0,
+                                             "first_date": None, "last_date": None, "recent": []})
+            rank = _to_number(row.get("着順"), int)
+            date = row.get("日付", "") or None
+            state["runs"] += 1
+            state["wins"] += rank == 1
+            state["top3"] += rank is not None and 1 <= rank <= 3
+            if date:
+                state["first_date"] = min(filter(None, (state["first_date"], date)))
+                state["last_date"] = max(filter(None, (state["last_date"], date)))
+            recent = state["recent"]
+            recent.append({col: row.get(col, "") for col in RECENT_COLUMNS})
+            # 日付の古いレースが後から来ることもあるため、日付順に並べ直して直近の分だけ残す
+            if len(recent) > 1 and (recent[-2]["日付"], recent[-2]["race_id"]) > (recent[-1]["日付"], recent[-1]["race_id"]):
+                recent.sort(key=lambda run: (run["日付"], run["race_id"]))
+            del recent[:-self.recent_runs]
+
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO horse_features ("馬", runs, wins, top3, first_date, last_date, recent) '
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(s["馬"], s["runs"], s["wins"], s["top3"], s["first_date"], s["last_date"],
+              json.dumps(s["recent"], ensure_ascii=False)) for s in states.values()],
+        )
+
+    def _update_jockeys(self, rows):
+        deltas = {}
+        for row in rows:
+            jockey = row.get("騎手", "")
+            if not jockey:
+                continue
+            key = (jockey, row.get("場名", ""), row.get("芝・ダート", ""), row.get("距離", ""))
+            rank = _to_number(row.get("着順"), int)
+            delta = deltas.setdefault(key, [0, 0, 0, ""])
+            delta[0] += 1
+            delta[1] += rank == 1
+            delta[2] += rank is not None and 1 <= rank <= 3
+            delta[3] = max(delta[3], row.get("日付", ""))
+        self.conn.executemany(
+            'INSERT INTO jockey_features ("騎手", "場名", "芝・ダート", "距離", rides, wins, top3, last_date) '
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            'ON CONFLICT ("騎手", "場名", "芝・ダート", "距離") DO UPDATE SET '
+            "rides = rides + excluded.rides, wins = wins + excluded.wins, top3 = top3 + excluded.top3, "
+            "last_date = NULLIF(MAX(COALESCE(last_date, ''), COALESCE(excluded.last_date, '')), '')",
+            [key + (rides, wins, top3, last_date or None) for key, (rides, wins, top3, last_date) in deltas.items()],
+        )
+
+    def import_csv(self, csv_path, batch_size=5000):
+        """append_to_csvで作成したCSVを読み込んで集計に取り込む（ストアを使い始める前のデータの取り込み用）"""
+        with open(csv_path, encoding="utf-8-sig", newline="") as f:
+            batch = []
+            for row in csv.DictReader(f):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    self.update(batch)
+                    batch = []
+            self.update(batch)
+
+    # --- 検索 ---
+
+    def horse_features(self, horse):
+        """
+        馬の集計を返す。記録がなければNone
+
+        Returns:
+            出走数・1着・3着以内の回数と勝率・複勝率、直近の出走のリスト（日付順）、
+            直近の出走の平均走破時間・平均上がり・体重変化の合計を含む辞書
+        """
+        row = self.conn.execute('SELECT * FROM horse_features WHERE "馬" = ?', (horse,)).fetchone()
+        if row is None:
+            return None
+        features = dict(row)
+        recent = json.loads(features.pop("recent"))
+        features["勝率"] = features["wins"] / features["runs"] if features["runs"] else 0.0
+        features["複勝率"] = features["top3"] / features["runs"] if features["runs"] else 0.0
+        features["recent"] = recent
+        features["平均走破時間"] = _mean([_to_number(run["走破時間"], float) for run in recent])
+        features["平均上がり"] = _mean([_to_number(run["上がり"], float) for run in recent])
+        diffs = [_to_number(run["体重変化"], int) for run in recent]
+        features["体重変化合計"] = sum(diff for diff in diffs if diff is not None)
+        return features
+
+    def jockey_stats(self, jockey, place_name=None, distance=None, surface=None):
+        """
+        騎手の騎乗数・1着・3着以内の回数と勝率・複勝率を返す
+
+        Args:
+            jockey: 騎手名
+            place_name: 場名（例: "東京"）。Noneなら全場
+            distance: 距離（例: 1600）。Noneなら全距離
+            surface: 芝・ダート（"芝"/"ダ" または "1"/"0"）。Noneなら両方
+        """
+        where, params = ['"騎手" = ?'], [jockey]
+        if place_name is not None:
+            where.append('"場名" = ?')
+            params.append(place_name)
+        if distance is not None:
+            where.append('"距離" = ?')
+            params.append(str(distance))
+        if surface is not None:
+            where.append('"芝・ダート" = ?')
+            params.append({"芝": "1", "ダ": "0"}.get(surface, str(surface)))
+        row = self.conn.execute(f"""
+            SELECT COALESCE(SUM(rides), 0) AS 騎乗数, COALESCE(SUM(wins), 0) AS 勝利数,
+                   COALESCE(SUM(top3), 0) AS 複勝数, MAX(last_date) AS 最終騎乗日
+            FROM jockey_features WHERE {" AND ".join(where)}
+        """, params).fetchone()
+        stats = dict(row)
+        stats["勝率"] = stats["勝利数"] / stats["騎乗数"] if stats["騎乗数"] else 0.0
+        stats["複勝率"] = stats["複勝数"] / stats["騎乗数"] if stats["騎乗数"] else 0.0
+        return stats
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,17 +1,163 @@
 #Pythonコード
 import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
 import os
+import sqlite3
 import requests
 import time
 import random
+import re
+import operator
+import socket
+import threading
+import warnings
+import multiprocessing
+import queue
+import lxml.html
 from bs4 import BeautifulSoup
-from datetime import datetime
-from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from keiba_db import RaceDatabase
+from keiba_features import FeatureStore
+
+try:
+    import numpy as np
+except ImportError: # numpyがない場合、clean_data_batchはclean_dataで処理する
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError: # OUTPUT_FORMAT = "parquet" の場合のみ必要
+    pa = ds = pq = None
 
 URL_BASE = "https://db.netkeiba.com/race/"
 CSV_DIR = "./data/"
 OUTPUT_FILE = f"{CSV_DIR}v25y0005_data02.csv"
 
+# 同時に処理するレース数の上限（リクエスト間隔はrate_limited_requestでホストごとに全体として制限される）
+MAX_WORKERS = 4
+# 取得したページの解析を行うプロセス数（0の場合はプロセスを分けずにスレッド1つで解析する）
+PARSE_PROCESSES = os.cpu_count() or 1
+# 取得→解析→書き込みの各段の間で保持するレース数の上限（超えると前の段が空くまで待つ）
+PIPELINE_QUEUE_SIZE = 16
+
+# === HTTP通信の設定 ===
+HTTP_TIMEOUT = 15 # タイムアウト（秒）
+HTTP_RETRIES = 3 # タイムアウトや5xxの際の再試行回数
+HTTP_BACKOFF = 2.0 # 再試行間隔の基準（秒）。2, 4, 8秒...と指数的に伸ばす
+HTTP_MAX_RETRY_WAIT = 120 # Retry-Afterなどで待機する時間の上限（秒）
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504) # 再試行の対象とするステータスコード
+
+# === リクエスト間隔の設定 ===
+# ホストごとに1秒あたりのリクエスト数を応答に合わせて調整する（AdaptiveRateLimiterを参照）
+# rate: 開始時のリクエスト数/秒, min_rate・max_rate: 調整する範囲, burst: 間隔を空けずに続けて送れる数
+# 登録していないホストには "default" を使う。max_rate 0.5 は同じホストへのリクエストが平均2秒以上空くことを表す
+# max_rate 0.4 で間隔は最短でも2.5秒（+ 揺らぎ）になり、固定の待機（2.5〜5秒）だった頃より詰めることはない
+RATE_LIMITS = {
+    "db.netkeiba.com": {"rate": 0.3, "min_rate": 0.05, "max_rate": 0.4, "burst": 1},
+    "default": {"rate": 0.3, "min_rate": 0.05, "max_rate": 0.4, "burst": 1},
+}
+RATE_INCREASE = 0.01 # 正常な応答ごとに増やすリクエスト数/秒（加算）
+RATE_DECREASE = 0.5 # 429/5xx・接続エラー・遅い応答・Retry-Afterの際に掛ける係数（乗算）
+RATE_SLOW_RESPONSE = 3.0 # 応答にこの秒数以上かかった場合は遅いとみなして間隔を広げる
+RATE_JITTER = 0.5 # 間隔に加えるランダムな揺らぎの上限（秒）
+
+# === HTMLキャッシュの設定 ===
+# 取得したレースページの生HTMLを圧縮して保存し、解析をやり直す際に再ダウンロードしないようにする
+CACHE_DIR = f"{CSV_DIR}html_cache/" # Noneでキャッシュを無効化
+CACHE_MAX_BYTES = 2 * 1024 ** 3 # キャッシュ全体（圧縮後）の上限。超えたら最も古く参照されたページから削除
+CACHE_REVALIDATE = False # Trueの場合、キャッシュ済みのページも条件付きGETで更新を確認する
+
+# === CSV書き込みの設定 ===
+WRITER_FLUSH_ROWS = 500 # バッファした行数がこれを超えたらファイルに書き出す
+WRITER_FLUSH_SECONDS = 30 # 前回の書き出しからこの秒数が経過したら書き出す
+WRITER_FSYNC = True # 書き出しのたびにfsyncしてディスクへの書き込みを保証する
+
+CSV_FIELDNAMES = [
+    "race_id", "着順", "枠番", "馬番", "馬", "性", "齢", "斤量", "騎手", "走破時間",
+    "通過順", "上がり", "人気", "オッズ", "体重", "体重変化",
+    "レース名", "日付", "開催", "クラス", "芝・ダート", "距離",
+    "回り", "馬場", "天気", "場id", "場名"
+]
+# ENRICH_PROFILESがTrueの場合にCSVの後ろに加える列
+HORSE_PROFILE_FIELDS = ["父", "母", "母父", "生年月日", "調教師", "馬主", "生産者", "通算成績", "獲得賞金"]
+JOCKEY_PROFILE_FIELDS = ["騎手1着", "騎手2着", "騎手3着", "騎手着外", "騎手勝率", "騎手連対率", "騎手複勝率"]
+PROFILE_FIELDNAMES = ["馬id", "騎手id"] + HORSE_PROFILE_FIELDS + JOCKEY_PROFILE_FIELDS
+
+def csv_fieldnames():
+    """新しく作成するCSVの列（ENRICH_PROFILESがTrueの場合はプロフィールの列を加える）"""
+    return CSV_FIELDNAMES + PROFILE_FIELDNAMES if ENRICH_PROFILES else CSV_FIELDNAMES
+
+# === 出力形式の設定 ===
+# "csv": CSVと同名の.txtに出力する（従来の形式）
+# "parquet": 列ごとに型を付けたParquetで、年度/場id/芝・ダートごとのディレクトリに分けて出力する（pyarrowが必要）
+#            出力先はOUTPUT_FILEの拡張子を除いた名前に "_parquet" を付けたディレクトリ
+OUTPUT_FORMAT = "csv"
+PARQUET_FLUSH_ROWS = 50000 # Parquetはファイル数が増えすぎないよう、まとめて書き出す行数を多めにする
+# Parquetを時間でも書き出す間隔（秒）。書き出しのたびにパーティションごとのファイルが増えるため、CSVより長くする
+# （異常終了した場合に取得し直すのは、最後の書き出し以降のレース）。Noneなら行数と終了時だけで書き出す
+PARQUET_FLUSH_SECONDS = 3600
+
+# === データベースの設定 ===
+# 出力ファイルと同じ行をSQLiteデータベースにも保存する（馬・騎手ごとの検索はkeiba_db.RaceDatabaseを使う）
+# 新しく作成した場合は、既にあるCSVの行も取り込む。Noneで無効化
+DATABASE_FILE = f"{CSV_DIR}keiba.sqlite"
+# 馬・騎手ごとの集計（keiba_features.FeatureStore）を、出力ファイルに書き出すたびに書き出したレースの分だけ更新する
+# 新しく作成した場合は、既にあるCSVの行も取り込む。Noneで無効化
+FEATURE_STORE_FILE = f"{CSV_DIR}keiba_features.sqlite"
+
+# === HTML解析の設定 ===
+# "lxml": lxmlのXPathで必要な部分だけを読む高速な解析（ページが宣言する文字コードでデコードする）
+# "bs4": BeautifulSoupでページ全体を解析する従来の方法（結果は"lxml"と同じ）
+PARSER_ENGINE = "lxml"
+
+# === 馬・騎手のプロフィールの設定 ===
+# Trueの場合、出走馬と騎手のプロフィールページ（血統・通算成績・騎手成績など）を取得してCSVの列に加える
+# 同じ馬・騎手のページはクロール中に1回だけ取得し、PROFILE_CACHE_FILEに保存したものは有効期限まで取得し直さない
+# 列を加えられるのは新しく作成するCSVだけ（Parquetや、列のない既存のCSVに追記する場合は取得しない）
+# reparse_from_cacheではページを取得せず、PROFILE_CACHE_FILEに保存したプロフィールだけを使う
+ENRICH_PROFILES = False
+PROFILE_URL_BASE = "https://db.netkeiba.com/"
+PROFILE_CACHE_FILE = f"{CSV_DIR}profile_cache.sqlite"
+PROFILE_TTL = {"horse": 7 * 86400, "jockey": 86400} # 保存したプロフィールの有効期限（秒）
+
+# === 開催カレンダーの設定 ===
+# 実際に存在した開催日・レースを記録し、次回以降は存在するレースのページだけを取得する
+CALENDAR_FILE = f"{CSV_DIR}race_calendar.json" # Noneで無効化（全組み合わせを取得する）
+
+# === 再開用の記録の設定 ===
+# race_idごとの処理状況を出力先と同じ場所の "<出力ファイル名>_manifest.sqlite"
+# （Parquetの場合は "<出力先ディレクトリ名>_manifest.sqlite"）に記録し、
+# 中断したクロールを続きから再開する（書き込み済み・存在しないレースは取得しない）
+USE_MANIFEST = True
+
+# === 分割クロールの設定（mode = "sharded"） ===
+# race_idの範囲を年度・場所・開催回ごとのシャードに分けて作業キュー（SQLite）に入れ、複数のワーカーが借りて取得する
+# 別のマシンでも同じSHARD_DIRを共有していれば（ファイルロックが使えるファイルシステムで）run_shard_workerで参加できる
+SHARD_DIR = f"{CSV_DIR}shards/"
+SHARD_QUEUE_FILE = f"{SHARD_DIR}queue.sqlite"
+SHARD_WORKERS = 4 # このマシンで起動するワーカープロセスの数（リクエスト間隔の制限はワーカーごとに行われる）
+SHARD_LEASE_SECONDS = 600 # シャードの貸出期間（ワーカーは処理中に延長し続け、異常終了すると期限切れで他のワーカーに貸し出される）
+SHARD_MAX_ATTEMPTS = 3 # この回数失敗したシャードは再度貸し出さない
+
+# === ログと処理状況のレポートの設定 ===
+# レースごとの詳細（取得するURL・待機時間・スキップしたレースなど）はDEBUGで出力する
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "text" # "json"の場合は1行1つのJSONで出力する（ログの集計・検索用）
+# クロールの終了時に段ごとの処理時間・待機時間・取得バイト数・結果の件数をJSONで保存する
+# 同じ名前の .prom にPrometheusのテキスト形式でも保存する。Noneで無効化
+REPORT_FILE = f"{CSV_DIR}crawl_report.json"
+
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:115.0) Gecko/20100101 Firefox/115.0',
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
@@ -20,59 +166,747 @@ USER_AGENTS = [
     'Mozilla/5.0 (iPhone; CPU iPhone OS 16_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1'
 ]
 
-# リクエスト間隔を管理するためのdeque
-request_timestamps = deque(maxlen=5) # 直近5回のタイムスタンプを保持（例）
-
-def rate_limited_request():
-    """リクエストレートを制限する（最低5秒間隔）。5回連続で短い間隔だった場合、長めに待機する可能性も考慮"""
-    now = time.time()
-    if len(request_timestamps) == request_timestamps.maxlen:
-        time_since_oldest = now - request_timestamps[0]
-        # 例えば、直近5回のリクエストが10秒以内に行われていたら少し長めに待つ
-        if time_since_oldest < 10:
-            wait_extra = random.uniform(5, 10)
-            print(f"[INFO] Short interval detected. Waiting an extra {wait_extra:.1f} seconds...")
-            time.sleep(wait_extra)
-
-    if request_timestamps and now - request_timestamps[-1] < 5:
-        wait_time = max(0, 2 - (now - request_timestamps[-1])) + random.uniform(0.5, 2) # 最低5秒 + α
-        print(f"[INFO] Waiting {wait_time:.1f} seconds before next request...")
-        time.sleep(wait_time)
-    request_timestamps.append(time.time()) # 実際の時間はリクエスト送信直前に入れるのが理想だが、ここでは簡略化
+logger = logging.getLogger("keiba_scraping")
+
+class CrawlStats:
+    """
+    クロール中の処理時間と件数を集計する（全スレッドで共有する）
+
+    指標はMETRICSの名前ごとに、ラベル（段の名前・理由・ステータスコードなど）別の値を足し上げる。
+    段ごとの処理時間はtimer()、待機時間はadd_sleep()、件数はinc()で記録する。
+    解析プロセスで集計した値はdrain()で取り出し、親プロセスでmerge()する。
+    """
+
+    # 指標の名前: (ラベルの名前, 説明)
+    METRICS = {
+        "stage_seconds": ("stage", "Wall time spent in each stage"),
+        "stage_calls": ("stage", "Number of timed calls of each stage"),
+        "sleep_seconds": ("reason", "Time spent sleeping or waiting before requests"),
+        "http_responses": ("status", "HTTP responses by status code (exception name if no response)"),
+        "http_bytes": (None, "Bytes of response bodies downloaded"),
+        "cache_lookups": ("result", "HTML cache lookups by result"),
+        "profile_lookups": ("result", "Horse/jockey profile lookups by result (memo, cache, fetched, failed)"),
+        "races": ("outcome", "Races by outcome"),
+        "rows_written": (None, "Rows passed to the writer"),
+        "errors": ("reason", "Errors and skipped rows by reason"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = {} # {(指標の名前, ラベル): 値}
+            self.started_at = time.time()
+
+    def inc(self, metric, label=None, value=1):
+        with self.lock:
+            key = (metric, label)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def add_sleep(self, reason, seconds):
+        self.inc("sleep_seconds", reason, seconds)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            for key, value in (("stage_seconds", seconds), ("stage_calls", 1)):
+                self.values[(key, stage)] = self.values.get((key, stage), 0) + value
+
+    @contextmanager
+    def timer(self, stage):
+        """with文の中の処理時間をstageの処理時間として記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def drain(self):
+        """集計した値を返して0に戻す"""
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+    def report(self):
+        """{指標の名前: {ラベル: 値}}（ラベルのない指標は値そのもの）の辞書を返す"""
+        with self.lock:
+            values = dict(self.values)
+            started_at = self.started_at
+        result = {"started_at": datetime.fromtimestamp(started_at, timezone.utc).isoformat(),
+                  "elapsed_seconds": round(time.time() - started_at, 3)}
+        for metric, (label_name, _) in self.METRICS.items():
+            if label_name is None:
+                result[metric] = values.get((metric, None), 0)
+            else:
+                result[metric] = {label: value for (name, label), value in sorted(values.items()) if name == metric}
+        return result
+
+    def prometheus_text(self, prefix="keiba_crawl"):
+        """report()の内容をPrometheusのテキスト形式にする"""
+        report = self.report()
+        lines = [f"# HELP {prefix}_elapsed_seconds Wall time since the crawl started",
+                 f"# TYPE {prefix}_elapsed_seconds gauge",
+                 f"{prefix}_elapsed_seconds {report['elapsed_seconds']}"]
+        for metric, (label_name, description) in self.METRICS.items():
+            name = f"{prefix}_{metric}_total"
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+            if label_name is None:
+                lines.append(f"{name} {report[metric]}")
+                continue
+            for label, value in report[metric].items():
+                escaped = str(label).replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'{name}{{{label_name}="{escaped}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, filepath):
+        """report()をJSONで、prometheus_text()を同じ名前の .prom に保存する"""
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        for path, text in ((filepath, json.dumps(self.report(), ensure_ascii=False, indent=1)),
+                           (os.path.splitext(filepath)[0] + ".prom", self.prometheus_text())):
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(f"{path}.tmp", path)
+
+    def summary(self):
+        """ログに出力する1行の要約"""
+        report = self.report()
+        stages = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in report["stage_seconds"].items())
+        sleeps = ", ".join(f"{reason} {seconds:.1f}s" for reason, seconds in report["sleep_seconds"].items())
+        races = ", ".join(f"{outcome} {count}" for outcome, count in report["races"].items())
+        return (f"Crawl finished in {report['elapsed_seconds']:.1f}s; {report['http_bytes'] / 1024 ** 2:.1f} MB downloaded; "
+                f"stages: {stages or '-'}; sleeps: {sleeps or '-'}; races: {races or '-'}; "
+                f"errors: {sum(report['errors'].values())}")
+
+# 全スレッドで共有する集計
+crawl_stats = CrawlStats()
+
+class JsonLogFormatter(logging.Formatter):
+    """ログを1行1つのJSONにする（extraで渡した値もそのまま含める）"""
+
+    _RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self._RESERVED})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging(level=None, fmt=None):
+    """LOG_LEVEL・LOG_FORMATに従ってログを標準エラー出力に出す"""
+    handler = logging.StreamHandler()
+    if (fmt or LOG_FORMAT) == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level or LOG_LEVEL)
+    logger.propagate = False
+
+class AdaptiveRateLimiter:
+    """
+    ホストごとのリクエスト間隔を応答に合わせて調整するレート制限（全スレッドで共有する）
+
+    ホストごとに、次にリクエストを送ってよい時刻を 1 / rate 秒（+ ランダムな揺らぎ）ずつ進めて予約する
+    トークンバケット（GCRA）で、burst 件までは間隔を空けずに送れる。予約はロックの中で行い、待機はロックの外で行うため、
+    待っているスレッドが他のスレッドの予約を妨げることはない。
+    rateはAIMDで調整する: 正常な応答のたびに increase を足し（max_rateまで）、429/5xx・接続エラー・
+    slow_response 秒以上かかった応答では decrease を掛ける（min_rateまで）。Retry-Afterが指定された場合は
+    その時刻まで同じホストへのリクエストをすべて止める。間隔を広げた場合やRetry-Afterの場合、既に予約して待機中のスレッドも
+    待機後に予約し直すため、広げる前の予約のままリクエストを送ることはない。
+    reserve()は待機せずに待つべき秒数を返すため、asyncioからは await asyncio.sleep(limiter.reserve(host)) で使える。
+    """
+
+    def __init__(self, limits=None, increase=RATE_INCREASE, decrease=RATE_DECREASE, slow_response=RATE_SLOW_RESPONSE,
+                 jitter=RATE_JITTER):
+        self.limits = limits if limits is not None else RATE_LIMITS
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_response = slow_response
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.hosts = {} # {ホスト: 状態の辞書}
+
+    def _state(self, host):
+        """ホストの状態を返す（呼び出し側でロックを保持すること）"""
+        state = self.hosts.get(host)
+        if state is None:
+            config = self.limits.get(host) or self.limits["default"]
+            # throttlesは間隔を広げた回数（待機中に増えた場合は予約し直す）
+            state = self.hosts[host] = dict(config, tat=0.0, blocked_until=0.0, throttles=0)
+        return state
+
+    def reserve(self, host):
+        """次のリクエストの送信時刻を予約し、それまでに待つ秒数を返す（待機はしない）"""
+        return self._reserve(host)[0]
+
+    def _reserve(self, host):
+        """(待つ秒数, 予約した時点で間隔を広げた回数) を返す"""
+        with self.lock:
+            state = self._state(host)
+            now = time.monotonic()
+            interval = 1 / state["rate"]
+            start = max(now, state["tat"] - (state["burst"] - 1) * interval, state["blocked_until"])
+            state["tat"] = max(state["tat"], start) + interval + random.uniform(0, self.jitter)
+            return start - now, state["throttles"]
+
+    def wait(self, host):
+        """予約した送信時刻まで待機し、待った秒数を返す。待機中に間隔が広げられた場合は予約し直して待つ"""
+        waited = 0.0
+        while True:
+            delay, throttles = self._reserve(host)
+            if delay > 0:
+                logger.debug("Waiting %.1f seconds before next request to %s...", delay, host)
+                time.sleep(delay)
+                crawl_stats.add_sleep("rate_limit", delay)
+                waited += delay
+            with self.lock:
+                state = self._state(host)
+                if state["throttles"] == throttles and time.monotonic() >= state["blocked_until"]:
+                    return waited
+            logger.debug("Requests to %s were throttled while waiting. Reserving again", host)
+
+    def record(self, host, status=None, elapsed=None, retry_after=None):
+        """
+        応答の結果からホストのrateを調整する
+
+        Args:
+            host: ホスト名
+            status: ステータスコード（接続エラー・タイムアウトの場合はNone）
+            elapsed: 応答までにかかった秒数
+            retry_after: Retry-Afterで指定された秒数
+        """
+        throttled = (status is None or status in HTTP_RETRY_STATUSES or retry_after is not None
+                     or (elapsed is not None and elapsed >= self.slow_response))
+        with self.lock:
+            state = self._state(host)
+            old_rate = state["rate"]
+            if throttled:
+                state["throttles"] += 1
+                state["rate"] = max(state["min_rate"], state["rate"] * self.decrease)
+                if retry_after is not None:
+                    state["blocked_until"] = max(state["blocked_until"], time.monotonic() + retry_after)
+                # 既に予約済みの時刻も新しい間隔に合わせて後ろにずらす
+                state["tat"] = max(state["tat"], time.monotonic() + 1 / state["rate"])
+            else:
+                state["rate"] = min(state["max_rate"], state["rate"] + self.increase)
+            rate = state["rate"]
+        if throttled and rate != old_rate:
+            logger.info(f"Slowing down requests to {host}: {old_rate:.3f} -> {rate:.3f} req/s "
+                        f"(status: {status}, elapsed: {elapsed if elapsed is None else round(elapsed, 2)}, retry_after: {retry_after})")
+
+    def rates(self):
+        """{ホスト: 現在のリクエスト数/秒}"""
+        with self.lock:
+            return {host: state["rate"] for host, state in self.hosts.items()}
+
+# 全スレッドで共有するリクエスト間隔の制御
+rate_limiter = AdaptiveRateLimiter()
+
+def request_host(url):
+    """レート制限の単位にするホスト名"""
+    return (urlsplit(url).hostname if url else None) or "default"
+
+def rate_limited_request(url=None):
+    """urlのホストへのリクエストを送ってよい時刻まで待つ（間隔はrate_limiterが応答に合わせて調整する）"""
+    rate_limiter.wait(request_host(url))
 
 def get_headers():
     """ランダムなUser-Agentを返す"""
     return {'User-Agent': random.choice(USER_AGENTS)}
 
+class HttpTransport:
+    """
+    接続を使い回すHTTPクライアント
+
+    1つのrequests.Sessionを全スレッドで共有し、db.netkeiba.comへのTCP/TLS接続をkeep-aliveで再利用する。
+    タイムアウト・接続エラー・429/5xxの場合は指数バックオフで再試行し、Retry-Afterヘッダーがあればそれに従う。
+    再試行も含めて各リクエストの前にrate_limited_request()を通すため、リクエスト間隔の制限は守られる。
+    応答のステータスコード・応答時間・Retry-Afterはrate_limiterに伝え、リクエスト間隔の調整に使う。
+    """
+
+    def __init__(self, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, timeout=HTTP_TIMEOUT, pool_size=MAX_WORKERS):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        # 同時に処理するスレッド数だけ接続を保持できるようにする
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def fetch(self, url, etag=None, last_modified=None):
+        """
+        URLを取得してレスポンスを返す
+
+        Args:
+            url: 取得するURL
+            etag: 前回取得時のETag（指定するとIf-None-Matchを送る）
+            last_modified: 前回取得時のLast-Modified（指定するとIf-Modified-Sinceを送る）
+
+        Returns:
+            requests.Response。条件付きGETで変更がなければステータスコード304のレスポンス
+
+        Raises:
+            requests.exceptions.RequestException: 再試行しても取得できなかった場合
+        """
+        headers = get_headers()
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        host = request_host(url)
+        for attempt in range(self.retries + 1):
+            rate_limited_request(url) # リクエスト前に待機チェック
+            start = time.perf_counter()
+            try:
+                with crawl_stats.timer("http"):
+                    res = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                rate_limiter.record(host, None, time.perf_counter() - start)
+                crawl_stats.inc("http_responses", e.__class__.__name__)
+                if attempt == self.retries:
+                    raise
+                wait_time = self._backoff_time(attempt)
+                logger.warning(f"{e.__class__.__name__} for {url}. Retrying in {wait_time:.1f} seconds ({attempt + 1}/{self.retries})...")
+                time.sleep(wait_time)
+                crawl_stats.add_sleep("retry_backoff", wait_time)
+                continue
+
+            retry_after = self._retry_after(res) if res.status_code in HTTP_RETRY_STATUSES else None
+            rate_limiter.record(host, res.status_code, time.perf_counter() - start, retry_after)
+            crawl_stats.inc("http_responses", str(res.status_code))
+            crawl_stats.inc("http_bytes", value=len(res.content))
+
+            if res.status_code in HTTP_RETRY_STATUSES and attempt < self.retries:
+                wait_time = retry_after
+                reason = "retry_after"
+                if wait_time is None:
+                    wait_time = self._backoff_time(attempt)
+                    reason = "retry_backoff"
+                logger.warning(f"HTTP {res.status_code} for {url}. Retrying in {wait_time:.1f} seconds ({attempt + 1}/{self.retries})...")
+                res.close()
+                time.sleep(wait_time)
+                crawl_stats.add_sleep(reason, wait_time)
+                continue
+
+            if res.status_code != 304:
+                res.raise_for_status() # ステータスコードが200以外なら例外を発生させる
+            return res
+
+    def _backoff_time(self, attempt):
+        """attempt回目の再試行までの待機時間（ジッター付き指数バックオフ）"""
+        return min(HTTP_MAX_RETRY_WAIT, self.backoff * (2 ** attempt) + random.uniform(0, 1))
+
+    def _retry_after(self, res):
+        """Retry-Afterヘッダー（秒数またはHTTP日付）から待機時間を求める。ヘッダーがなければNone"""
+        value = res.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(HTTP_MAX_RETRY_WAIT, max(0, seconds))
+
+# 全スレッドで共有するHTTPクライアント
+transport = HttpTransport()
+
+class HtmlCache:
+    """
+    race_idをキーにした生HTMLのキャッシュ
+
+    HTML本体はSHA-256のダイジェストをファイル名としてgzip圧縮で保存し（同じ内容は1つだけ保存される）、
+    race_idとダイジェスト・ETag・Last-Modifiedの対応はSQLiteの索引で管理する。
+    圧縮後の合計サイズが max_bytes を超えた場合は、最後に参照された時刻が古いページから削除する。
+    """
+
+    def __init__(self, cache_dir, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                race_id TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS objects (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at);
+        """)
+        self.conn.commit()
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], f"{digest}.html.gz")
+
+    def get(self, race_id):
+        """キャッシュ済みのページを (HTMLのバイト列, ETag, Last-Modified) で返す。なければNone"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest, etag, last_modified FROM pages WHERE race_id = ?", (race_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE pages SET accessed_at = ? WHERE race_id = ?", (time.time(), race_id))
+            self.conn.commit()
+        digest, etag, last_modified = row
+        try:
+            with gzip.open(self._object_path(digest), "rb") as f:
+                return f.read(), etag, last_modified
+        except (OSError, EOFError) as e:
+            logger.warning(f"Broken cache entry for race {race_id}: {e}")
+            crawl_stats.inc("errors", "broken_cache_entry")
+            return None
+
+    def put(self, race_id, content, etag=None, last_modified=None):
+        """ページをキャッシュに保存する"""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object_path(digest)
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 書き込み途中のファイルが残らないよう、一時ファイルに書いてから置き換える
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            now = time.time()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO objects (digest, size) VALUES (?, ?)", (digest, os.path.getsize(path))
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (race_id, digest, etag, last_modified, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (race_id, digest, etag, last_modified, now, now),
+            )
+            self.conn.commit()
+            self._evict()
+
+    def touch(self, race_id):
+        """条件付きGETで変更がなかったページの取得時刻を更新する"""
+        with self.lock:
+            now = time.time()
+            self.conn.execute("UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE race_id = ?", (now, now, race_id))
+            self.conn.commit()
+
+    def race_ids(self):
+        """キャッシュ済みのrace_idを昇順で返す"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT race_id FROM pages ORDER BY race_id")]
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば古いページから削除する（呼び出し側でロックを保持すること）"""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for race_id, digest in self.conn.execute("SELECT race_id, digest FROM pages ORDER BY accessed_at").fetchall():
+            self.conn.execute("DELETE FROM pages WHERE race_id = ?", (race_id,))
+            # 他のrace_idから参照されていないHTMLだけを削除する
+            if self.conn.execute("SELECT 1 FROM pages WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+                size = self.conn.execute("SELECT size FROM objects WHERE digest = ?", (digest,)).fetchone()
+                self.conn.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+                try:
+                    os.remove(self._object_path(digest))
+                except OSError:
+                    pass
+                total -= size[0] if size else 0
+                if total <= self.max_bytes:
+                    break
+        self.conn.commit()
+        logger.info(f"Cache evicted down to {total / 1024 ** 2:.1f} MB")
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    """HTMLキャッシュを返す（初回呼び出し時に作成）。CACHE_DIRがNoneの場合はNone"""
+    global _page_cache
+    if CACHE_DIR is None:
+        return None
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = HtmlCache(CACHE_DIR, CACHE_MAX_BYTES)
+        return _page_cache
+
+def decode_html(content):
+    """HTMLのバイト列を文字コードを推定してデコードする"""
+    encoding = requests.compat.chardet.detect(content)["encoding"] or "utf-8"
+    return content.decode(encoding, errors="replace")
+
+# <meta charset="..."> または <meta http-equiv="Content-Type" content="...; charset=..."> の文字コード
+_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset=["']?([A-Za-z0-9_\-]+)""", re.IGNORECASE)
+
+def decode_declared_html(content):
+    """HTMLのバイト列をページが宣言している文字コードでデコードする（宣言がなければ推定する）"""
+    match = _CHARSET_PATTERN.search(content, 0, 4096)
+    if match:
+        try:
+            return content.decode(match.group(1).decode("ascii"), errors="replace")
+        except LookupError:
+            pass
+    return decode_html(content)
+
+class Bs4RacePage:
+    """BeautifulSoupでページ全体を解析する（従来の実装で、解析結果の基準となる）"""
+
+    def __init__(self, content):
+        self.soup = BeautifulSoup(decode_html(content), 'lxml')
+        self.race_info_box = self.soup.find("div", class_="data_intro")
+
+    def has_race_info(self):
+        return self.race_info_box is not None
+
+    def race_info_text(self, tag_name):
+        """レース情報の中で最初に現れるタグのテキスト。タグがなければNone"""
+        tag = self.race_info_box.find(tag_name)
+        return tag.text if tag else None
+
+    def result_rows(self):
+        """レース結果テーブルの行のリスト。テーブルがなければNone"""
+        race_table = self.soup.find("table", class_="race_table_01 nk_tb_common")
+        return race_table.find_all("tr") if race_table is not None else None
+
+    def cells(self, row):
+        """行のセルのテキスト（前後の空白を除去）のリスト"""
+        return [col.text.strip() for col in row.find_all("td")]
+
+    def links(self, row, indexes):
+        """行の指定した位置のセルにある最初のリンク先（リンクがなければ空文字）のリスト"""
+        cols = row.find_all("td")
+        links = []
+        for index in indexes:
+            a = cols[index].find("a", href=True) if index < len(cols) else None
+            links.append(a["href"] if a else "")
+        return links
+
+class LxmlRacePage:
+    """lxmlのXPathでレース情報と結果テーブルだけを読む（Bs4RacePageと同じ結果を返す）"""
+
+    def __init__(self, content):
+        self.root = lxml.html.document_fromstring(decode_declared_html(content))
+        boxes = self.root.xpath('//div[contains(concat(" ", normalize-space(@class), " "), " data_intro ")]')
+        self.race_info_box = boxes[0] if boxes else None
+
+    def has_race_info(self):
+        return self.race_info_box is not None
+
+    def race_info_text(self, tag_name):
+        """レース情報の中で最初に現れるタグのテキスト。タグがなければNone"""
+        tags = self.race_info_box.xpath(f"(.//{tag_name})[1]")
+        return tags[0].text_content() if tags else None
+
+    def result_rows(self):
+        """レース結果テーブルの行のリスト。テーブルがなければNone"""
+        tables = self.root.xpath('//table[normalize-space(@class)="race_table_01 nk_tb_common"]')
+        return tables[0].xpath(".//tr") if tables else None
+
+    def cells(self, row):
+        """行のセルのテキスト（前後の空白を除去）のリスト"""
+        return [col.text_content().strip() for col in row.iterdescendants("td")]
+
+    def links(self, row, indexes):
+        """行の指定した位置のセルにある最初のリンク先（リンクがなければ空文字）のリスト"""
+        cols = list(row.iterdescendants("td"))
+        links = []
+        for index in indexes:
+            a = next((a for a in cols[index].iterdescendants("a") if a.get("href")), None) if index < len(cols) else None
+            links.append(a.get("href") if a is not None else "")
+        return links
+
+PARSER_ENGINES = {"bs4": Bs4RacePage, "lxml": LxmlRacePage}
+
+# /horse/2019104858/ や /jockey/result/recent/01167/ の形のリンクからIDを取り出す
+_PROFILE_ID_PATTERN = re.compile(r"/(?:horse|jockey)/(?:result/recent/)?([0-9A-Za-z]+)")
+
+def profile_id(link):
+    """馬・騎手のページへのリンクからIDを取り出す。取り出せなければ空文字"""
+    match = _PROFILE_ID_PATTERN.search(link) if link else None
+    return match.group(1) if match else ""
+
+class Entry:
+    """出走馬1頭分の結果（レース情報は持たず、Raceのentriesに入れる）"""
+    __slots__ = ("着順", "枠番", "馬番", "馬", "性", "齢", "斤量", "騎手", "走破時間",
+                 "通過順", "上がり", "人気", "オッズ", "体重", "体重変化", "馬id", "騎手id")
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def values(self):
+        return _entry_values(self)
+
+_entry_values = operator.attrgetter(*Entry.__slots__)
+
+class Race:
+    """
+    1レース分のデータ（レース情報は1つだけ持ち、出走馬ごとの結果はEntryのリストで持つ）
+
+    get_race_dataの戻り値のような1頭ごとの辞書（レース情報を各行に複製したもの）はto_rows()で、
+    CSVなどに書き出す時点で作る。len()は出走馬の数を返す。
+    """
+    __slots__ = ("race_id", "レース名", "日付", "開催", "クラス", "芝ダート", "距離",
+                 "回り", "馬場", "天気", "場id", "場名", "entries")
+    # 行の辞書での列名（"芝・ダート"は属性名に使えない文字を含むため、属性名は芝ダートにしている）
+    COLUMNS = ("レース名", "日付", "開催", "クラス", "芝・ダート", "距離", "回り", "馬場", "天気", "場id", "場名")
+
+    def __init__(self, race_id, *values, entries=None):
+        self.race_id = race_id
+        for name, value in zip(self.__slots__[1:-1], values):
+            setattr(self, name, value)
+        self.entries = entries if entries is not None else []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def header(self):
+        """レース情報を行の辞書と同じ列名の辞書で返す"""
+        return dict(zip(self.COLUMNS, _race_values(self)))
+
+    def to_rows(self):
+        """1頭ごとの辞書のリスト（get_race_dataの戻り値と同じ形）にする"""
+        header = self.header()
+        race_id = self.race_id
+        return [{"race_id": race_id, **dict(zip(Entry.__slots__, entry.values())), **header} for entry in self.entries]
+
+_race_values = operator.attrgetter(*Race.__slots__[1:-1])
+
+def race_rows(data):
+    """Raceまたは1頭ごとの辞書のリストを、辞書のリストにする"""
+    return data.to_rows() if isinstance(data, Race) else data
+
+def _race_id(data):
+    return data.race_id if isinstance(data, Race) else data[0].get("race_id", "")
+
+def fetch_race_page(race_id):
+    """
+    レースページの生HTMLを取得する（キャッシュがあればキャッシュから返す）
+
+    Raises:
+        requests.exceptions.RequestException: 取得に失敗した場合
+    """
+    with crawl_stats.timer("fetch"):
+        return _fetch_race_page(race_id)
+
+def _fetch_race_page(race_id):
+    cache = get_page_cache()
+    cached = cache.get(race_id) if cache else None
+    if cache:
+        crawl_stats.inc("cache_lookups", "hit" if cached else "miss")
+    if cached and not CACHE_REVALIDATE:
+        return cached[0]
+
+    url = URL_BASE + race_id
+    logger.debug("Accessing: %s", url)
+    etag, last_modified = (cached[1], cached[2]) if cached else (None, None)
+    res = transport.fetch(url, etag=etag, last_modified=last_modified)
+    if res.status_code == 304:
+        crawl_stats.inc("cache_lookups", "not_modified")
+        cache.touch(race_id)
+        return cached[0]
+
+    content = res.content
+    # 存在しないrace_idのページはキャッシュしない（後日公開される可能性があるため）
+    if cache and b"data_intro" in content:
+        cache.put(race_id, content, res.headers.get("ETag"), res.headers.get("Last-Modified"))
+    return content
+
+def page_exists(content):
+    """レースページにレース情報が含まれているか（存在するrace_idか）を判定する"""
+    return b"data_intro" in content
+
+def fetch_and_parse_race(race_id, content=None, distance_conditions=None, surface_conditions=None):
+    """
+    race_idのページを取得・解析する
+
+    Args:
+        race_id: レースID
+        content: 取得済みのHTML（バイト列）。Noneの場合は取得する
+        distance_conditions: 距離条件のリスト（合わないレースは結果テーブルを解析しない）
+        surface_conditions: 芝・ダート条件のリスト（同上）
+
+    Returns:
+        (exists, race, race_info) のタプル。existsはページが存在すればTrue、存在しなければFalse、
+        取得に失敗して判定できない場合はNone。raceはRace（レース情報が見つからなければNone）、
+        race_infoはレース情報（距離・芝・ダートなど）の辞書
+    """
+    if content is None:
+        try:
+            content = fetch_race_page(race_id)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Request failed for race {race_id}: {e}")
+            return None, None, None
+    race_info, race = _parse_race_page(content, race_id, distance_conditions, surface_conditions)
+    return page_exists(content), race, race_info
+
 def get_race_data(race_id):
     """指定されたrace_idのレースデータをnetkeiba.comから取得して構造化する"""
-    url = URL_BASE + race_id
+    race = fetch_and_parse_race(race_id)[1]
+    return race.to_rows() if race else []
+
+def parse_race_page(content, race_id, distance_conditions=None, surface_conditions=None, engine=None):
+    """
+    レースページのHTML（バイト列）を解析し、1頭ごとの辞書のリストにする
+
+    距離・芝・ダートの条件が指定されている場合は、レース情報の時点で条件に合わなければ
+    結果テーブルを解析せずに空のリストを返す。engineで解析方法（PARSER_ENGINESのキー）を指定できる。
+    """
+    race = _parse_race_page(content, race_id, distance_conditions, surface_conditions, engine)[1]
+    return race.to_rows() if race else []
+
+def _parse_race_page(content, race_id, distance_conditions, surface_conditions, engine=None):
+    """
+    (レース情報の辞書, Race) を返す。レース情報が見つからなければ (None, None)
+
+    条件に合わない場合や結果テーブルが見つからない場合は、出走馬のいないRaceを返す。
+    """
     try:
-        rate_limited_request() # リクエスト前に待機チェック
-        print(f"[INFO] Accessing: {url}")
-        res = requests.get(url, headers=get_headers(), timeout=15) # タイムアウトを少し延長
-        res.raise_for_status() # ステータスコードが200以外なら例外を発生させる
-        res.encoding = res.apparent_encoding
-        soup = BeautifulSoup(res.text, 'lxml')
-
-        race_info_box = soup.find("div", class_="data_intro")
-        if not race_info_box:
-            print(f"[WARN] Race info box not found for race_id: {race_id}")
-            return []
+        page = PARSER_ENGINES[engine or PARSER_ENGINE](content)
+
+        if not page.has_race_info():
+            logger.warning(f"Race info box not found for race_id: {race_id}")
+            crawl_stats.inc("errors", "race_info_not_found")
+            return None, None
 
         # --- レース情報の抽出 ---
-        race_name_tag = race_info_box.find("h1")
-        race_name = race_name_tag.text.strip() if race_name_tag else "レース名不明"
+        race_name_text = page.race_info_text("h1")
+        race_name = race_name_text.strip() if race_name_text is not None else "レース名不明"
 
-        race_data_p = race_info_box.find("p")
-        race_data_text = race_data_p.text.strip().replace('\xa0', ' ') if race_data_p else ""
+        race_data_p_text = page.race_info_text("p")
+        race_data_text = race_data_p_text.strip().replace('\xa0', ' ') if race_data_p_text is not None else ""
 
         lines = race_data_text.split("\n")
         race_date_str = lines[0].split("：")[-1].strip() if len(lines) > 0 and "： " in lines[0] else ""
         try:
             race_date = datetime.strptime(race_date_str, "%Y年%m月%d日").strftime("%Y-%m-%d") if race_date_str else ""
         except ValueError:
-            print(f"[WARN] Could not parse date: {race_date_str} in race {race_id}")
+            logger.warning(f"Could not parse date: {race_date_str} in race {race_id}")
+            crawl_stats.inc("errors", "date_parse_error")
             race_date = ""
 
         info_line = lines[1].strip() if len(lines) > 1 else ""
@@ -81,9 +915,9 @@ def get_race_data(race_id):
 
         # "クラス"情報が含まれているかチェックして抽出 (例: '3歳未勝利', 'G1' など)
         # これはページ構造によって異なるため、より堅牢な方法が必要になる場合がある
-        details_span = race_info_box.find("span")
-        if details_span:
-            details_text = details_span.text.strip().replace('\xa0', ' ')
+        details_span_text = page.race_info_text("span")
+        if details_span_text is not None:
+            details_text = details_span_text.strip().replace('\xa0', ' ')
             details_parts = details_text.split('/')
             # --- 詳細情報の解析 ---
             # この部分はサイトの構造変更に弱い可能性があるため注意
@@ -106,45 +940,54 @@ def get_race_data(race_id):
 
         place_id = race_id[4:6]
         place_name = 開催.split("回")[-1].split("日")[0] if 開催 else "" # 例: "1回東京1日" -> "東京"
+        race_info = {"距離": 距離, "芝・ダート": 芝ダート}
+        race = Race(race_id, race_name, race_date, 開催, クラス, 芝ダート, 距離, 回り, 馬場, 天気, place_id, place_name)
+
+        # 条件に合わないレースは結果テーブルを解析しない
+        mismatch = _condition_mismatch(距離, 芝ダート, distance_conditions, surface_conditions)
+        if mismatch:
+            logger.debug("Skipping race %s - %s", race_id, mismatch)
+            return race_info, race
 
         # --- レース結果テーブルの抽出 ---
-        race_table = soup.find("table", class_="race_table_01 nk_tb_common")
-        if race_table is None:
-            print(f"[WARN] Race result table not found for race_id: {race_id}")
-            return []
+        rows = page.result_rows()
+        if rows is None:
+            logger.warning(f"Race result table not found for race_id: {race_id}")
+            crawl_stats.inc("errors", "result_table_not_found")
+            return race_info, race
 
-        rows = race_table.find_all("tr")
         if len(rows) < 2: # ヘッダー行 + データ行が最低1つないと処理できない
-            print(f"[WARN] No data rows found in table for race_id: {race_id}")
-            return []
+            logger.warning(f"No data rows found in table for race_id: {race_id}")
+            crawl_stats.inc("errors", "no_data_rows")
+            return race_info, race
 
         rows = rows[1:] # ヘッダー行を除外
-        race_data = []
 
         for i, row in enumerate(rows):
-            cols = row.find_all("td")
+            cols = page.cells(row)
             # === 修正点: 列数チェックを強化 ===
             # 必須データ(着順～タイム、単勝、人気、馬体重)が存在するであろうインデックス14までチェック
             if len(cols) < 15:
-                print(f"[WARN] Row {i+1} in race {race_id} has less than 15 columns ({len(cols)}), skipping.")
+                logger.warning(f"Row {i+1} in race {race_id} has less than 15 columns ({len(cols)}), skipping.")
+                crawl_stats.inc("errors", "short_row")
                 continue
             try:
                 # --- 各列データの抽出 ---
-                着順 = cols[0].text.strip()
-                枠番 = cols[1].text.strip()  # 枠番を追加
-                馬番 = cols[2].text.strip()
-                馬名 = cols[3].text.strip()
-                性齢 = cols[4].text.strip()
-                斤量 = cols[5].text.strip()
-                騎手 = cols[6].text.strip()
-                走破時間 = cols[7].text.strip()
+                着順 = cols[0]
+                枠番 = cols[1]  # 枠番を追加
+                馬番 = cols[2]
+                馬名 = cols[3]
+                性齢 = cols[4]
+                斤量 = cols[5]
+                騎手 = cols[6]
+                走破時間 = cols[7]
 
                 # === 修正点: 正しいインデックスを参照 ===
-                通過順 = cols[10].text.strip() if len(cols) > 10 else ""
-                上がり = cols[11].text.strip() if len(cols) > 11 else ""
-                オッズ = cols[12].text.strip() if len(cols) > 12 else ""
-                人気 = cols[13].text.strip() if len(cols) > 13 else ""
-                馬体重_データ = cols[14].text.strip()
+                通過順 = cols[10] if len(cols) > 10 else ""
+                上がり = cols[11] if len(cols) > 11 else ""
+                オッズ = cols[12] if len(cols) > 12 else ""
+                人気 = cols[13] if len(cols) > 13 else ""
+                馬体重_データ = cols[14]
 
                 # 性別と年齢を分割
                 sex, age = "", ""
@@ -162,52 +1005,174 @@ def get_race_data(race_id):
                 elif 馬体重_データ: # 体重のみの場合 (例: 計不)
                     weight = 馬体重_データ
 
-                # 取得データを辞書に格納
-                data = {
-                    "race_id": race_id,
-                    "着順": 着順,
-                    "枠番": 枠番,  # 枠番を追加
-                    "馬番": 馬番,
-                    "馬": 馬名,
-                    "性": sex,
-                    "齢": age,
-                    "斤量": 斤量,
-                    "騎手": 騎手,
-                    "走破時間": 走破時間,
-                    "通過順": 通過順, # 修正済み
-                    "上がり": 上がり, # 修正済み
-                    "人気": 人気,
-                    "オッズ": オッズ,
-                    "体重": weight, # 修正済み (元データ参照先変更)
-                    "体重変化": weight_diff, # 修正済み (元データ参照先変更)
-                    # --- レース情報 ---
-                    "レース名": race_name,
-                    "日付": race_date,
-                    "開催": 開催,
-                    "クラス": クラス, # 注意: クラス情報の取得は改善が必要な場合あり
-                    "芝・ダート": 芝ダート,
-                    "距離": 距離,
-                    "回り": 回り,
-                    "馬場": 馬場,
-                    "天気": 天気,
-                    "場id": place_id,
-                    "場名": place_name
-                }
-                race_data.append(data)
+                # 馬と騎手のプロフィールページのID（リンク先のURLから取り出す）
+                horse_id, jockey_id = (profile_id(link) for link in page.links(row, (3, 6)))
+
+                # 取得データを格納（レース情報はRaceが持つ）
+                race.entries.append(Entry(
+                    着順, 枠番, 馬番, 馬名, sex, age, 斤量, 騎手, 走破時間,
+                    通過順, 上がり, 人気, オッズ, weight, weight_diff, horse_id, jockey_id
+                ))
             except Exception as e:
-                print(f"[WARN] Parsing error in row {i+1} for race {race_id}: {e}")
+                logger.warning(f"Parsing error in row {i+1} for race {race_id}: {e}")
+                crawl_stats.inc("errors", "row_parse_error")
                 # エラーが発生した行のcols内容を出力するとデバッグに役立つ
-                # print(f"[DEBUG] Problematic row data: {[c.text.strip() for c in cols]}")
+                logger.debug("Problematic row data: %s", cols)
                 continue
 
-        return race_data
+        return race_info, race
 
-    except requests.exceptions.RequestException as e:
-        print(f"[ERROR] Request failed for race {race_id}: {e}")
-        return []
     except Exception as e:
-        print(f"[ERROR] An unexpected error occurred while processing race {race_id}: {e}")
-        return []
+        logger.error(f"An unexpected error occurred while processing race {race_id}: {e}")
+        crawl_stats.inc("errors", "parse_error")
+        return None, None
+
+class ProfileCache:
+    """
+    取得した馬・騎手のプロフィールを保存するキャッシュ（SQLite）
+
+    (種類, ID) ごとにプロフィールの辞書をJSONで保存し、ttl（種類ごとの秒数）を過ぎたものは期限切れとして扱う。
+    """
+
+    def __init__(self, filepath, ttl=None):
+        self.filepath = filepath
+        self.ttl = ttl if ttl is not None else PROFILE_TTL
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS profiles (
+                kind TEXT NOT NULL,
+                profile_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (kind, profile_id)
+            );
+        """)
+        self.conn.commit()
+
+    def get(self, kind, profile_id):
+        """保存したプロフィールを返す。なければ、または期限切れならNone"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data, fetched_at FROM profiles WHERE kind = ? AND profile_id = ?", (kind, profile_id)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl.get(kind, 0):
+            return None
+        return json.loads(row[0])
+
+    def put(self, kind, profile_id, data):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO profiles (kind, profile_id, data, fetched_at) VALUES (?, ?, ?, ?)",
+                (kind, profile_id, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def parse_horse_profile(content):
+    """馬のページからプロフィール（HORSE_PROFILE_FIELDSの列）を取り出す"""
+    root = lxml.html.document_fromstring(decode_declared_html(content))
+    profile = {}
+    for row in root.xpath('//table[contains(concat(" ", normalize-space(@class), " "), " db_prof_table ")]//tr'):
+        th, td = row.find("th"), row.find("td")
+        if th is None or td is None:
+            continue
+        name = th.text_content().strip()
+        for field in HORSE_PROFILE_FIELDS:
+            # "獲得賞金 (中央)" のように補足が付く項目もあるため前方一致で対応付ける
+            if name.startswith(field) and field not in profile:
+                profile[field] = " ".join(td.text_content().split())
+    # 血統表は 父・母 が2行にまたがるセルで、母父は母の行の2番目のセル
+    blood = root.xpath('//table[contains(concat(" ", normalize-space(@class), " "), " blood_table ")]')
+    if blood:
+        parents = blood[0].xpath('.//td[@rowspan="2"]')
+        for field, cell in zip(("父", "母"), parents):
+            profile[field] = cell.text_content().strip()
+        rows = blood[0].xpath(".//tr")
+        if len(rows) > 2 and len(rows[2].findall("td")) > 1:
+            profile["母父"] = rows[2].findall("td")[1].text_content().strip()
+    return profile
+
+def parse_jockey_profile(content):
+    """騎手のページの年度別成績の表から、累計（なければ最初の年度）の成績（JOCKEY_PROFILE_FIELDSの列）を取り出す"""
+    root = lxml.html.document_fromstring(decode_declared_html(content))
+    for table in root.xpath("//table[.//th[normalize-space()='勝率']]"):
+        header = [th.text_content().strip() for th in table.xpath(".//tr[th][1]/th")]
+        rows = [[td.text_content().strip() for td in tr.xpath("td|th")] for tr in table.xpath(".//tr[td]")]
+        if not rows:
+            continue
+        values = next((row for row in rows if row and "累計" in row[0]), rows[0])
+        columns = dict(zip(header, values))
+        return {f"騎手{name}": columns[name] for name in ("1着", "2着", "3着", "着外", "勝率", "連対率", "複勝率")
+                if name in columns}
+    return {}
+
+PROFILE_PARSERS = {"horse": parse_horse_profile, "jockey": parse_jockey_profile}
+
+class ProfileEnricher:
+    """
+    出走馬と騎手のプロフィールを取得して行に加える
+
+    同じ馬・騎手のプロフィールは1回のクロールで1回だけ調べ（結果はメモに残す）、cache（ProfileCache）に
+    有効期限内のものがあればページを取得しない。人気の騎手は数百レースに出るため、取得するページ数は出走数よりはるかに少ない。
+    ページの取得はレースページと同じtransportを使うため、リクエスト間隔の制限も共有する。
+    取得に失敗したプロフィールは空として扱い、キャッシュには保存しない（次回のクロールで取得し直す）。
+    offlineがTrueの場合はページを取得せず、cacheにないプロフィールは空として扱う。
+    """
+
+    def __init__(self, cache=None, offline=False):
+        self.cache = cache
+        self.offline = offline
+        self.memo = {} # {(種類, ID): プロフィールの辞書}
+        self.lock = threading.Lock()
+
+    def profile(self, kind, profile_id):
+        """kind（"horse"/"jockey"）のプロフィールを返す。IDがなければ空の辞書"""
+        if not profile_id:
+            return {}
+        key = (kind, profile_id)
+        with self.lock:
+            if key in self.memo:
+                crawl_stats.inc("profile_lookups", "memo")
+                return self.memo[key]
+        data = self.cache.get(kind, profile_id) if self.cache else None
+        if data is not None:
+            crawl_stats.inc("profile_lookups", "cache")
+        elif self.offline:
+            crawl_stats.inc("profile_lookups", "offline_miss")
+            data = {}
+        else:
+            url = f"{PROFILE_URL_BASE}{kind}/{profile_id}/"
+            logger.debug("Accessing: %s", url)
+            try:
+                data = PROFILE_PARSERS[kind](transport.fetch(url).content)
+            except Exception as e:
+                # 通信の失敗のほか、空のページ（lxmlのParserError）など解析できないページも1件の失敗として扱い、
+                # 1つのプロフィールのためにクロール全体を止めない
+                logger.warning(f"Could not fetch {kind} profile {profile_id}: {e}")
+                crawl_stats.inc("profile_lookups", "failed")
+                data = {}
+            else:
+                crawl_stats.inc("profile_lookups", "fetched")
+                if self.cache:
+                    self.cache.put(kind, profile_id, data)
+        with self.lock:
+            self.memo[key] = data
+        return data
+
+    def enrich(self, data):
+        """1レース分のデータ（Raceまたは行のリスト）を、プロフィールの列を加えた行のリストにする"""
+        rows = race_rows(data)
+        for row in rows:
+            horse = self.profile("horse", row.get("馬id", ""))
+            jockey = self.profile("jockey", row.get("騎手id", ""))
+            row.update({field: horse.get(field, "") for field in HORSE_PROFILE_FIELDS})
+            row.update({field: jockey.get(field, "") for field in JOCKEY_PROFILE_FIELDS})
+        return rows
 
 def clean_data(data):
     """辞書のリストを受け取り、文字列型の値に含まれるNBSPをスペースに置き換える + 通過順に'を追加 + 走破時間を秒単位に変換 + 芝・ダートと回りを数値に変換 + 性と天気を数値に変換"""
@@ -228,7 +1193,8 @@ def clean_data(data):
                             total_seconds = float(minutes) * 60 + float(seconds)
                             v = f"{total_seconds:.1f}"
                     except ValueError:
-                        print(f"[WARN] Could not convert race time: {v}")
+                        logger.warning(f"Could not convert race time: {v}")
+                        crawl_stats.inc("errors", "race_time_conversion")
                 # 芝・ダートを数値に変換（芝=1, ダート=0）
                 elif k == "芝・ダート":
                     if v == "芝":
@@ -261,51 +1227,542 @@ def clean_data(data):
         cleaned.append(new_row)
     return cleaned
 
-def append_to_csv(data, filepath):
-    if not data:
+class RaceWriter:
+    """
+    CSVファイルと同名の.txtファイルへの書き込みをまとめて行うライター
+
+    ファイルは開いたままにして、レース単位でバッファした行を一定の行数・時間ごとにまとめて書き出す。
+    クリーニングも書き出しの際にclean_data_batchでまとめて行う。
+    書き出しは1レースの途中で区切らず、各ファイルへ1回のwriteで行ってからfsyncし、
+    書き出し終えた時点の各ファイルのサイズを「CSVファイル名.flushed」に記録する。
+    開く際にファイルが記録したサイズより大きい（前回の書き出しの途中で異常終了した）場合は、
+    記録したサイズまで切り詰めて、途中までしか書き出されなかったレースの行を全て取り除く。
+    記録がないファイル（この仕組みより前に作成したもの）は、末尾の改行で終わっていない行だけを切り詰める。
+    最後に必ずclose()する（with文で使うこともできる）。
+
+    既にファイルに含まれているrace_idのレースは書き込まない（同じ範囲を取得し直しても行が重複しない）。
+    databaseにRaceDatabaseを指定すると、ファイルに書き出した行を同じタイミングでデータベースにも保存する。
+    featuresにFeatureStoreを指定すると、同じタイミングで馬・騎手ごとの集計も更新する。
+    on_flushを指定すると、書き出してfsyncした後に書き出したレースのrace_idのリストを渡して呼び出す。
+    列はfieldnames（既定はCSV_FIELDNAMES）だが、既にあるファイルに追記する場合はファイルのヘッダーの列に合わせる。
+    """
+
+    def __init__(self, filepath, flush_rows=WRITER_FLUSH_ROWS, flush_seconds=WRITER_FLUSH_SECONDS, fsync=WRITER_FSYNC,
+                 on_flush=None, database=None, features=None, fieldnames=None):
+        self.filepath = filepath
+        self.txt_filepath = filepath.replace(".csv", ".txt")
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.csv_buffer = [] # 書き出し待ちのCSVのテキスト（ヘッダー）
+        self.pending_races = [] # 書き出し待ちのレース（Raceまたは行のリスト。行にするのは書き出す時）
+        self.pending_race_ids = []
+        self.buffered_rows = 0
+        self.last_flush = time.time()
+        self.on_flush = on_flush
+        self.database = database
+        self.features = features
+
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        self.marker_filepath = f"{filepath}.flushed"
+        _truncate_to_flush_boundary(self.marker_filepath, (self.filepath, self.txt_filepath))
+        file_exists = os.path.isfile(filepath) and os.path.getsize(filepath) > 0
+        self.existing_race_ids = _read_csv_race_ids(filepath) if file_exists else set()
+        self.fieldnames = (_read_csv_header(filepath) if file_exists else None) or fieldnames or CSV_FIELDNAMES
+        self.csv_file = open(filepath, "a", newline="", encoding="utf-8-sig")
+        self.txt_file = open(self.txt_filepath, "a", encoding="utf-8")
+        self._save_flush_boundary()
+        if not file_exists:
+            header = io.StringIO()
+            csv.DictWriter(header, fieldnames=self.fieldnames, quoting=csv.QUOTE_ALL).writeheader()
+            self.csv_buffer.append(header.getvalue())
+
+    def write_race(self, data):
+        """1レース分のデータ（Race、またはget_race_dataの戻り値）をバッファに追加する。書き込み済みのレースならFalseを返す"""
+        if not data:
+            return False
+        race_id = _race_id(data)
+        if race_id in self.existing_race_ids:
+            logger.debug("Race %s is already in %s. Skipping.", race_id, self.filepath)
+            return False
+        self.existing_race_ids.add(race_id)
+        self.pending_race_ids.append(race_id)
+        self.pending_races.append(data)
+        self.buffered_rows += len(data)
+        if self.buffered_rows >= self.flush_rows or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+        return True
+
+    def flush(self):
+        """バッファした行をまとめてクリーニングし、ファイルに書き出す"""
+        txt_text = ""
+        data_to_write = []
+        if self.pending_races:
+            with crawl_stats.timer("clean"):
+                data_to_write = clean_data_batch([row for data in self.pending_races for row in race_rows(data)])
+            with crawl_stats.timer("write"):
+                csv_text = io.StringIO()
+                writer = csv.DictWriter(csv_text, fieldnames=self.fieldnames, extrasaction='ignore', quoting=csv.QUOTE_ALL)
+                writer.writerows(data_to_write)
+                self.csv_buffer.append(csv_text.getvalue())
+
+                # --- 追加: txtファイルへの追記 ---
+                txt_text = "".join(
+                    "\t".join([str(row.get(col, "")) for col in self.fieldnames]) + "\n" for row in data_to_write
+                )
+            crawl_stats.inc("rows_written", value=len(data_to_write))
+
+        if self.csv_buffer:
+            with crawl_stats.timer("write"):
+                for f, text in ((self.csv_file, "".join(self.csv_buffer)), (self.txt_file, txt_text)):
+                    f.write(text)
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+                self._save_flush_boundary()
+        if self.database is not None and data_to_write:
+            with crawl_stats.timer("database"):
+                self.database.insert_races(data_to_write)
+        if self.features is not None and data_to_write:
+            with crawl_stats.timer("features"):
+                self.features.update(data_to_write)
+        if self.on_flush and self.pending_race_ids:
+            self.on_flush(self.pending_race_ids)
+        self.csv_buffer = []
+        self.pending_races = []
+        self.pending_race_ids = []
+        self.buffered_rows = 0
+        self.last_flush = time.time()
+
+    def remove_races(self, race_ids):
+        """
+        指定したrace_idの行をCSVとtxtから削除する（書き込み途中で異常終了したレースを取り除くために使う）
+
+        ファイル全体を書き直すため、バッファが空のとき（開いた直後）に呼び出すこと。
+        """
+        race_ids = set(race_ids) & self.existing_race_ids
+        if not race_ids:
+            return
+        self.csv_file.close()
+        self.txt_file.close()
+        for path, encoding in ((self.filepath, "utf-8-sig"), (self.txt_filepath, "utf-8")):
+            if not os.path.isfile(path):
+                continue
+            tmp_path = f"{path}.tmp"
+            with open(path, encoding=encoding, newline="") as src, open(tmp_path, "w", encoding=encoding, newline="") as dst:
+                for line in src:
+                    # CSVは "race_id",... 、txtは race_id\t... の形式なので先頭の列だけを見る
+                    first = line.split("\t" if path == self.txt_filepath else ",", 1)[0].strip('"')
+                    if first not in race_ids:
+                        dst.write(line)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, path)
+        self.existing_race_ids -= race_ids
+        logger.warning(f"Removed {len(race_ids)} partially written races from {self.filepath}")
+        self.csv_file = open(self.filepath, "a", newline="", encoding="utf-8-sig")
+        self.txt_file = open(self.txt_filepath, "a", encoding="utf-8")
+        self._save_flush_boundary()
+
+    def _save_flush_boundary(self):
+        """書き出し済みの各ファイルのサイズを記録する（一時ファイルに書いてから置き換える）"""
+        sizes = {path: os.path.getsize(path) for path in (self.filepath, self.txt_filepath)}
+        with open(f"{self.marker_filepath}.tmp", "w", encoding="utf-8") as f:
+            json.dump({os.path.basename(path): size for path, size in sizes.items()}, f, ensure_ascii=False)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(f"{self.marker_filepath}.tmp", self.marker_filepath)
+
+    def close(self):
+        """残りの行を書き出してファイルを閉じる"""
+        try:
+            self.flush()
+        finally:
+            self.csv_file.close()
+            self.txt_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _truncate_to_flush_boundary(marker_path, paths):
+    """
+    各ファイルをmarker_pathに記録した最後の書き出し時点のサイズまで切り詰める
+
+    記録がない（読めない）場合は、各ファイルの末尾の改行で終わっていない部分だけを削除する。
+    """
+    try:
+        with open(marker_path, encoding="utf-8") as f:
+            sizes = json.load(f)
+    except (OSError, ValueError):
+        for path in paths:
+            _truncate_partial_line(path)
         return
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    file_exists = os.path.isfile(filepath)
+    for path in paths:
+        size = sizes.get(os.path.basename(path))
+        if size is None:
+            _truncate_partial_line(path)
+        elif os.path.isfile(path) and os.path.getsize(path) > size:
+            with open(path, "rb+") as f:
+                f.truncate(size)
+            logger.warning(f"Removed rows written after the last completed flush from {path}")
 
-    data_to_write = clean_data(data)
+def _truncate_partial_line(path):
+    """ファイル末尾の改行で終わっていない（書き込み途中の）部分を削除する"""
+    if not os.path.isfile(path):
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        # 末尾から最後の改行を探す
+        pos = size
+        while pos > 0:
+            start = max(0, pos - 65536)
+            f.seek(start)
+            chunk = f.read(pos - start)
+            index = chunk.rfind(b"\n")
+            if index >= 0:
+                f.truncate(start + index + 1)
+                logger.warning(f"Removed an incomplete line at the end of {path}")
+                return
+            pos = start
+        f.truncate(0)
 
-    fieldnames = [
-        "race_id", "着順", "枠番", "馬番", "馬", "性", "齢", "斤量", "騎手", "走破時間",
-        "通過順", "上がり", "人気", "オッズ", "体重", "体重変化",
-        "レース名", "日付", "開催", "クラス", "芝・ダート", "距離",
-        "回り", "馬場", "天気", "場id", "場名"
-    ]
+def clean_data_batch(data):
+    """
+    clean_dataと同じ結果を列単位の一括変換で求める（多数の行をまとめてクリーニングする場合に速い）
+
+    行の辞書を列ごとのリストに分け、列の異なる値ごとに1回だけ変換した対応表を列全体に当てはめる
+    （騎手・芝・ダート・天気など、どの列も行数に比べて値の種類が少ないため）。値が変わらない列は書き換えない。
+    異なる値の変換は、走破時間はNumPyの配列演算でまとめて秒に変換し、その他の列はclean_dataそのものを使う。
+    NumPyがない場合や、行ごとにキーが異なる場合はclean_dataで処理する。
+    """
+    if not data:
+        return []
+    keys = tuple(data[0])
+    if np is None or any(tuple(row) != keys for row in data):
+        return clean_data(data)
 
+    # 行をコピーし、変換によって値が変わる列だけを書き換える
+    cleaned = [row.copy() for row in data]
+    for key in keys:
+        column = _clean_column(key, [row[key] for row in data])
+        if column is not None:
+            for row, value in zip(cleaned, column):
+                row[key] = value
+    return cleaned
+
+def _clean_column(key, values):
+    """列の異なる値ごとに変換した対応表を作り、列全体を変換する。どの値も変わらない場合はNone"""
+    try:
+        unique_values = list(set(values))
+    except TypeError: # ハッシュできない値を含む列は1つずつ変換する
+        return [clean_data([{key: v}])[0][key] for v in values]
+    if key == "走破時間" and all(isinstance(v, str) for v in unique_values):
+        cleaned_values = _clean_race_times(unique_values)
+    else:
+        cleaned_values = [clean_data([{key: v}])[0][key] for v in unique_values]
+    if cleaned_values == unique_values:
+        return None
+    mapping = dict(zip(unique_values, cleaned_values))
+    return list(map(mapping.__getitem__, values))
+
+def _clean_race_times(values):
+    """走破時間（"分:秒" 形式）の文字列のリストを配列演算でまとめて秒に変換する"""
+    times = np.char.replace(np.array(values, dtype=str), '\xa0', ' ')
+    parts = np.char.partition(times, ":")
+    # "分:秒" の形（コロンが1つ）の値だけを一括で変換する
+    convertible = (parts[:, 1] == ":") & (np.char.find(parts[:, 2], ":") < 0)
     try:
-        with open(filepath, "a", newline="", encoding="utf-8-sig") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore', quoting=csv.QUOTE_ALL)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerows(data_to_write)
-
-        # --- 追加: txtファイルへの追記 ---
-        txt_filepath = filepath.replace(".csv", ".txt")
-        with open(txt_filepath, "a", encoding="utf-8") as txtfile:
-            for row in data_to_write:
-                line = "\t".join([str(row.get(col, "")) for col in fieldnames])
-                txtfile.write(line + "\n")
-
-    except IOError as e:
-        print(f"[ERROR] Failed to write to CSV file {filepath}: {e}")
+        minutes = parts[convertible, 0].astype(np.float64)
+        seconds = parts[convertible, 2].astype(np.float64)
+    except ValueError: # 数値でない値を含む場合は警告の出力も含めてclean_dataと同じ処理にする
+        return [clean_data([{"走破時間": v}])[0]["走破時間"] for v in values]
+
+    cleaned = times.tolist()
+    for index, total_seconds in zip(np.flatnonzero(convertible).tolist(), (minutes * 60 + seconds).tolist()):
+        cleaned[index] = f"{total_seconds:.1f}"
+    # コロンが2つ以上ある値は変換できない（clean_dataと同じく警告を出して元の値のままにする）
+    for index in np.flatnonzero(~convertible & (parts[:, 1] == ":")).tolist():
+        cleaned[index] = clean_data([{"走破時間": values[index]}])[0]["走破時間"]
+    return cleaned
+
+# Parquetに出力する列の型（clean_data後の文字列から変換する）
+_PARQUET_INT_COLUMNS = {"着順": "int16", "枠番": "int8", "馬番": "int8", "性": "int8", "齢": "int8", "人気": "int16",
+                        "体重": "int16", "体重変化": "int16", "距離": "int16", "回り": "int8"}
+_PARQUET_FLOAT_COLUMNS = {"斤量", "走破時間", "上がり", "オッズ"}
+_PARQUET_PARTITION_COLUMNS = ["year", "場id", "芝・ダート"]
+
+def _parquet_schema():
+    """Parquetに出力する列のスキーマ（パーティションの列は含まない）"""
+    fields = []
+    for col in CSV_FIELDNAMES:
+        if col in _PARQUET_PARTITION_COLUMNS:
+            continue
+        if col in _PARQUET_INT_COLUMNS:
+            fields.append(pa.field(col, getattr(pa, _PARQUET_INT_COLUMNS[col])()))
+        elif col in _PARQUET_FLOAT_COLUMNS:
+            fields.append(pa.field(col, pa.float64()))
+        elif col == "日付":
+            fields.append(pa.field(col, pa.date32()))
+        else:
+            # 騎手・馬・場名など値の種類が限られる文字列は辞書エンコードする
+            fields.append(pa.field(col, pa.dictionary(pa.int32(), pa.string())))
+    return pa.schema(fields)
+
+def _parquet_partitioning():
+    """年度/場id/芝・ダートのhive形式のパーティション（場idは先頭の0を残すため文字列）"""
+    return ds.partitioning(
+        pa.schema([("year", pa.int16()), ("場id", pa.string()), ("芝・ダート", pa.string())]), flavor="hive"
+    )
+
+def _to_number(value, cast):
+    """文字列を数値に変換する。空文字や "計不"・"中止" など変換できない値はNone"""
+    if not value:
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        return None
+
+class ParquetRaceWriter:
+    """
+    型付きの列指向形式（Parquet）でレースを書き出すライター（RaceWriterと同じ使い方ができる）
+
+    着順・馬番・距離などは整数、走破時間・オッズなどは浮動小数点数、騎手・馬・場名などは辞書エンコードした文字列で保存する。
+    出力は dirpath/year=2025/場id=05/芝・ダート=1/part-*.parquet のように分かれるため、
+    読み込み時に必要なパーティションと列だけを読むことができる（read_parquet_datasetを参照）。
+    """
+
+    def __init__(self, dirpath, flush_rows=PARQUET_FLUSH_ROWS, flush_seconds=PARQUET_FLUSH_SECONDS, on_flush=None,
+                 database=None, features=None):
+        if pa is None:
+            raise ImportError("pyarrow is required for OUTPUT_FORMAT = \"parquet\" (pip install pyarrow)")
+        self.dirpath = dirpath
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.schema = _parquet_schema()
+        self.partitions = {} # {(year, 場id, 芝・ダート): {列名: 値のリスト}}
+        self.buffered_rows = 0
+        self.last_flush = time.time()
+        self.file_count = 0
+        self.on_flush = on_flush
+        self.database = database
+        self.features = features
+        self.pending_race_ids = []
+        self.pending_rows = [] # データベース・集計に渡す行（クリーニング後）
+        os.makedirs(dirpath, exist_ok=True)
+        self.existing_race_ids = set(self._dataset_column("race_id"))
+
+    def _dataset_column(self, column):
+        """書き出し済みのファイルから1列だけを読み込む"""
+        if not any(name.endswith(".parquet") for _, _, names in os.walk(self.dirpath) for name in names):
+            return []
+        return read_parquet_dataset(self.dirpath, columns=[column]).column(column).to_pylist()
+
+    def write_race(self, data):
+        """1レース分のデータ（Race、またはget_race_dataの戻り値）をクリーニングしてバッファに追加する。書き込み済みのレースならFalseを返す"""
+        if not data:
+            return False
+        race_id = _race_id(data)
+        if race_id in self.existing_race_ids:
+            logger.debug("Race %s is already in %s. Skipping.", race_id, self.dirpath)
+            return False
+        self.existing_race_ids.add(race_id)
+        self.pending_race_ids.append(race_id)
+        with crawl_stats.timer("clean"):
+            cleaned = clean_data(race_rows(data))
+        crawl_stats.inc("rows_written", value=len(cleaned))
+        if self.database is not None or self.features is not None:
+            self.pending_rows.extend(cleaned)
+        for row in cleaned:
+            race_id = row.get("race_id", "")
+            key = (race_id[:4], row.get("場id", ""), row.get("芝・ダート", ""))
+            columns = self.partitions.setdefault(key, {field.name: [] for field in self.schema})
+            for field in self.schema:
+                value = row.get(field.name, "")
+                if field.name in _PARQUET_INT_COLUMNS:
+                    value = _to_number(value, int)
+                elif field.name in _PARQUET_FLOAT_COLUMNS:
+                    value = _to_number(value, float)
+                elif field.name == "日付":
+                    value = datetime.strptime(value, "%Y-%m-%d").date() if value else None
+                columns[field.name].append(value)
+            self.buffered_rows += 1
+        if self.buffered_rows >= self.flush_rows or (
+                self.flush_seconds is not None and time.time() - self.last_flush >= self.flush_seconds):
+            self.flush()
+        return True
+
+    def flush(self):
+        """バッファした行をパーティションごとに新しいParquetファイルとして書き出す"""
+        with crawl_stats.timer("write"):
+            self._write_partitions()
+        if self.database is not None and self.pending_rows:
+            with crawl_stats.timer("database"):
+                self.database.insert_races(self.pending_rows)
+        if self.features is not None and self.pending_rows:
+            with crawl_stats.timer("features"):
+                self.features.update(self.pending_rows)
+        if self.on_flush and self.pending_race_ids:
+            self.on_flush(self.pending_race_ids)
+        self.partitions = {}
+        self.pending_race_ids = []
+        self.pending_rows = []
+        self.buffered_rows = 0
+        self.last_flush = time.time()
+
+    def _write_partitions(self):
+        for (year, place_id, surface), columns in self.partitions.items():
+            partition_dir = os.path.join(self.dirpath, f"year={year}", f"場id={place_id}", f"芝・ダート={surface}")
+            os.makedirs(partition_dir, exist_ok=True)
+            path = os.path.join(partition_dir, f"part-{time.time_ns()}-{self.file_count:05d}.parquet")
+            self.file_count += 1
+            table = pa.Table.from_pydict(columns, schema=self.schema)
+            # 書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換える
+            pq.write_table(table, f"{path}.tmp", compression="zstd")
+            os.replace(f"{path}.tmp", path)
+
+    def remove_races(self, race_ids):
+        """指定したrace_idの行を含むファイルを、その行を除いて書き直す"""
+        race_ids = set(race_ids) & self.existing_race_ids
+        if not race_ids:
+            return
+        for root, _, names in os.walk(self.dirpath):
+            for name in names:
+                if not name.endswith(".parquet"):
+                    continue
+                path = os.path.join(root, name)
+                table = pq.ParquetFile(path).read()
+                keep = [race_id not in race_ids for race_id in table.column("race_id").to_pylist()]
+                if all(keep):
+                    continue
+                pq.write_table(table.filter(pa.array(keep)), f"{path}.tmp", compression="zstd")
+                os.replace(f"{path}.tmp", path)
+        self.existing_race_ids -= race_ids
+        logger.warning(f"Removed {len(race_ids)} partially written races from {self.dirpath}")
+
+    def close(self):
+        """残りの行を書き出す"""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_parquet_dataset(dirpath, columns=None, filter=None):
+    """
+    ParquetRaceWriterで書き出したデータを読み込む
+
+    Args:
+        dirpath: 出力先のディレクトリ
+        columns: 読み込む列名のリスト（Noneなら全列）
+        filter: pyarrow.datasetの条件式。パーティションの列の条件は該当しないディレクトリを読まずに済む
+                （例: (ds.field("year") == 2024) & (ds.field("場id") == "05")）
+
+    Returns:
+        pyarrow.Table（pandasのDataFrameが必要なら .to_pandas() で変換する）
+    """
+    if pa is None:
+        raise ImportError("pyarrow is required to read the parquet output (pip install pyarrow)")
+    dataset = ds.dataset(dirpath, format="parquet", partitioning=_parquet_partitioning())
+    return dataset.to_table(columns=columns, filter=filter)
+
+def open_race_writer(output_file, on_flush=None, database=None, features=None):
+    """OUTPUT_FORMATに応じたライターを作る"""
+    if OUTPUT_FORMAT == "parquet":
+        return ParquetRaceWriter(os.path.splitext(output_file)[0] + "_parquet", on_flush=on_flush, database=database,
+                                 features=features)
+    return RaceWriter(output_file, on_flush=on_flush, database=database, features=features, fieldnames=csv_fieldnames())
+
+def open_database(output_file):
+    """
+    DATABASE_FILEのデータベースを開く（Noneなら何もしない）
+
+    データベースを新しく作成した場合は、output_fileのCSVに既に含まれる行を取り込んでから返す。
+    """
+    if not DATABASE_FILE:
+        return None
+    is_new = not os.path.isfile(DATABASE_FILE)
+    database = RaceDatabase(DATABASE_FILE)
+    if is_new and os.path.isfile(output_file) and os.path.getsize(output_file) > 0:
+        logger.info(f"Importing {output_file} into {DATABASE_FILE}...")
+        database.import_csv(output_file)
+    return database
+
+def open_feature_store(output_file):
+    """
+    FEATURE_STORE_FILEの集計を開く（Noneなら何もしない）
+
+    新しく作成した場合は、output_fileのCSVに既に含まれる行を取り込んでから返す。
+    """
+    if not FEATURE_STORE_FILE:
+        return None
+    is_new = not os.path.isfile(FEATURE_STORE_FILE)
+    features = FeatureStore(FEATURE_STORE_FILE)
+    if is_new and os.path.isfile(output_file) and os.path.getsize(output_file) > 0:
+        logger.info(f"Importing {output_file} into {FEATURE_STORE_FILE}...")
+        features.import_csv(output_file)
+    return features
+
+def _read_csv_header(filepath):
+    """CSVファイルのヘッダー行の列名のリスト"""
+    with open(filepath, encoding="utf-8-sig", newline="") as f:
+        return next(csv.reader(f), None)
+
+def _read_csv_race_ids(filepath):
+    """CSVファイルに含まれるrace_idの集合を返す"""
+    with open(filepath, encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None) # ヘッダー行
+        return {row[0] for row in reader if row}
+
+def append_to_csv(data, filepath):
+    """
+    1レース分の行をCSVとtxtに追記する（非推奨。RaceWriterを開いたままwrite_raceを呼び出すこと）
+
+    呼び出すたびにRaceWriterを開き直すため、CSV全体のrace_idの読み込み・データベースと集計の接続・
+    fsyncを1レースごとに行う。レースごとに呼び出すとCSVが大きくなるほど遅くなる（全体では行数の2乗に比例する）。
+    """
+    warnings.warn("append_to_csv is deprecated; keep a RaceWriter open and call write_race instead",
+                  DeprecationWarning, stacklevel=2)
+    if not data:
+        return
+    database = features = None
+    try:
+        database = open_database(filepath)
+        features = open_feature_store(filepath)
+        with RaceWriter(filepath, database=database, features=features) as writer:
+            writer.write_race(data)
+    except (IOError, sqlite3.Error) as e:
+        logger.error(f"Failed to write to CSV file {filepath}: {e}")
     except Exception as e:
-        print(f"[ERROR] An unexpected error occurred during CSV writing: {e}")
+        logger.error(f"An unexpected error occurred during CSV writing: {e}")
+    finally:
+        for store in (database, features):
+            if store is not None:
+                store.close()
 
 def filter_race_by_conditions(race_data, distance_conditions=None, surface_conditions=None):
     """
     レースデータを距離と芝・ダートの条件でフィルタリングする
     
     Args:
-        race_data: レースデータのリスト
+        race_data: レースデータのリスト（またはRace）
         distance_conditions: 距離条件のリスト (例: ["1200", "1600", "2000"])
         surface_conditions: 芝・ダート条件のリスト (例: ["芝", "ダ"] または ["1", "0"])
     
     Returns:
-        条件に合致するレースデータのリスト
+        条件に合致するレースデータのリスト（Raceを渡した場合はRace）
     """
     if not race_data:
         return []
@@ -315,14 +1772,27 @@ def filter_race_by_conditions(race_data, distance_conditions=None, surface_condi
         return race_data
     
     # 最初のレースデータから条件をチェック（同じレース内では距離と芝・ダートは同じ）
-    first_race = race_data[0]
-    race_distance = first_race.get("距離", "")
-    race_surface = first_race.get("芝・ダート", "")
+    if isinstance(race_data, Race):
+        race_distance = race_data.距離
+        race_surface = race_data.芝ダート
+    else:
+        race_distance = race_data[0].get("距離", "")
+        race_surface = race_data[0].get("芝・ダート", "")
+    race_id = _race_id(race_data)
+
+    mismatch = _condition_mismatch(race_distance, race_surface, distance_conditions, surface_conditions)
+    if mismatch:
+        logger.debug("Skipping race %s - %s", race_id, mismatch)
+        return []
     
+    logger.debug("Including race %s - distance: %sm, surface: %s", race_id, race_distance, race_surface)
+    return race_data
+
+def _condition_mismatch(race_distance, race_surface, distance_conditions=None, surface_conditions=None):
+    """距離・芝・ダートが条件に合わない場合はその理由を、合う場合はNoneを返す"""
     # 距離条件のチェック
     if distance_conditions and race_distance not in distance_conditions:
-        print(f"[INFO] Skipping race {first_race.get('race_id', '')} - distance {race_distance}m not in conditions {distance_conditions}")
-        return []
+        return f"distance {race_distance}m not in conditions {distance_conditions}"
     
     # 芝・ダート条件のチェック（文字列と数値の両方に対応）
     if surface_conditions:
@@ -344,11 +1814,922 @@ def filter_race_by_conditions(race_data, distance_conditions=None, surface_condi
                 numeric_conditions.append(condition)  # 既に数値の場合
         
         if surface_value not in numeric_conditions:
-            print(f"[INFO] Skipping race {first_race.get('race_id', '')} - surface {race_surface} (value: {surface_value}) not in conditions {surface_conditions}")
-            return []
-    
-    print(f"[INFO] Including race {first_race.get('race_id', '')} - distance: {race_distance}m, surface: {race_surface}")
-    return race_data
+            return f"surface {race_surface} (value: {surface_value}) not in conditions {surface_conditions}"
+    return None
+
+def generate_race_ids(target_years, target_kaisai_list, target_nichi_list, target_places):
+    """年度・開催回数・開催日目・場所の組み合わせからrace_idを順番に生成する"""
+    total_years = len(target_years)
+    total_kaisai = len(target_kaisai_list)
+    total_nichi = len(target_nichi_list)
+
+    for year_index, target_year in enumerate(target_years, 1):
+        logger.info(f"Processing year: {target_year} ({year_index}/{total_years})")
+        for kaisai_index, target_kaisai in enumerate(target_kaisai_list, 1):
+            logger.info(f"Processing kaisai: {target_kaisai} ({kaisai_index}/{total_kaisai})")
+            for nichi_index, target_nichi in enumerate(target_nichi_list, 1):
+                logger.debug("Processing nichi: %s (%d/%d)", target_nichi, nichi_index, total_nichi)
+                for place_id_str in target_places:
+                    for race_num in range(1, 13): # 1レースから12レースまで
+                        yield f"{target_year}{place_id_str}{target_kaisai}{target_nichi}{race_num:02d}"
+        logger.info(f"Completed year: {target_year}")
+
+class RaceCalendar:
+    """
+    開催日ごとに実際に存在するレース番号を記録する索引（JSONファイルに保存する）
+
+    開催日のキーはrace_idの先頭10桁（年度・場所・開催回数・開催日目）。
+    {"races": {"01": {"距離": "1600", "芝・ダート": "芝"}, ...}, "checked": "YYYY-MM-DD"} の形で保存し、
+    racesが空の開催日は存在しない開催日を表す。1日分の12レースすべての有無が分かった時点で記録する。
+    レースごとの距離・芝・ダートも記録し、条件に合わないレースは次回以降取得せずに済むようにする。
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.days = {}
+        self.observed = {} # 記録前の開催日ごとの観測結果 {day_key: {race_num: (exists, race_info)}}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if os.path.isfile(filepath):
+            try:
+                with open(filepath, encoding="utf-8") as f:
+                    self.days = json.load(f).get("days", {})
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not load race calendar {filepath}: {e}")
+
+    def known_races(self, day_key):
+        """
+        記録済みの開催日のレース番号のリストを返す。未記録の場合はNone
+
+        存在しないと記録した開催日でも、今年以降の分は後から開催される可能性があるため未記録として扱う。
+        """
+        day = self.days.get(day_key)
+        if day is None:
+            return None
+        if not day["races"] and int(day_key[:4]) >= datetime.now().year:
+            return None
+        return sorted(day["races"])
+
+    def race_info(self, race_id):
+        """記録済みのレース情報（距離・芝・ダート）を返す。未記録の場合は空の辞書"""
+        day = self.days.get(race_id[:10])
+        return day["races"].get(race_id[10:], {}) if day else {}
+
+    def mark_day_missing(self, day_key):
+        """開催日が存在しないことを記録する"""
+        with self.lock:
+            self.days[day_key] = {"races": {}, "checked": datetime.now().strftime("%Y-%m-%d")}
+            self.observed.pop(day_key, None)
+            self._save()
+
+    def record(self, race_id, exists, race_info=None):
+        """レースの有無とレース情報を記録する。開催日の12レースすべての有無が揃ったらファイルに保存する"""
+        day_key, race_num = race_id[:10], race_id[10:]
+        info = {k: race_info[k] for k in ("距離", "芝・ダート") if k in race_info} if race_info else {}
+        with self.lock:
+            day = self.days.get(day_key)
+            if day is not None and race_num in day["races"]:
+                # 記録済みの開催日はレース情報だけを更新する（保存はsave()で行う）
+                if info and day["races"][race_num] != info:
+                    day["races"][race_num] = info
+                    self.dirty = True
+                return
+            observed = self.observed.setdefault(day_key, {})
+            observed[race_num] = (exists, info)
+            if len(observed) < 12:
+                return
+            races = day["races"] if day else {}
+            self.days[day_key] = {
+                "races": {num: found_info or races.get(num, {}) for num, (found, found_info) in sorted(observed.items()) if found},
+                "checked": datetime.now().strftime("%Y-%m-%d"),
+            }
+            del self.observed[day_key]
+            self._save()
+
+    def save(self):
+        """未保存の変更があればファイルに保存する"""
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _save(self):
+        """一時ファイルに書き込んでから置き換える（呼び出し側でロックを保持すること）"""
+        os.makedirs(os.path.dirname(self.filepath) or ".", exist_ok=True)
+        tmp_path = f"{self.filepath}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"days": self.days}, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.filepath)
+        self.dirty = False
+
+class CrawlManifest:
+    """
+    race_idごとの処理状況を記録する（SQLite）
+
+    状態は次のいずれか:
+      fetched（取得済み）, parsed（解析済みで書き出し待ち）, written（出力ファイルに書き出し済み）,
+      nonexistent（存在しないレース）, filtered（条件に合わず書き出さなかった）, failed（取得・解析に失敗）
+    written・nonexistent のレースと、同じ条件で filtered になったレースは次回以降処理しない。
+    書き込みの多いクロール中でも遅くならないよう、コミットはまとめて行う（commit()・ライターの書き出し時）。
+    """
+
+    DONE_STATES = ("written", "nonexistent")
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS races (
+                race_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                detail TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS races_state ON races (state);
+        """)
+        self.conn.commit()
+        self.pending = 0
+
+    def set_state(self, race_id, state, detail=None):
+        """race_idの状態を記録する（コミットはまとめて行う）"""
+        self.set_states([race_id], state, detail)
+
+    def set_states(self, race_ids, state, detail=None):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO races (race_id, state, detail, updated_at) VALUES (?, ?, ?, ?)",
+                [(race_id, state, detail, now) for race_id in race_ids],
+            )
+            self.pending += len(race_ids)
+            if self.pending >= 1000:
+                self._commit()
+
+    def mark_written(self, race_ids):
+        """ライターが書き出した（fsync済みの）レースを記録してすぐにコミットする"""
+        self.set_states(race_ids, "written")
+        self.commit()
+
+    def state(self, race_id):
+        """(状態, 詳細) を返す。未記録の場合は (None, None)"""
+        with self.lock:
+            row = self.conn.execute("SELECT state, detail FROM races WHERE race_id = ?", (race_id,)).fetchone()
+        return row if row else (None, None)
+
+    def is_done(self, race_id, filter_key=""):
+        """処理済み（次回以降取得しなくてよい）レースか"""
+        state, detail = self.state(race_id)
+        if state == "nonexistent":
+            # 今年以降のレースは後から公開される可能性があるため、存在しなかったレースも確認し直す
+            return int(race_id[:4]) < datetime.now().year
+        return state in self.DONE_STATES or (state == "filtered" and detail == filter_key)
+
+    def race_ids(self, states):
+        """指定した状態のrace_idの集合"""
+        placeholders = ", ".join("?" for _ in states)
+        with self.lock:
+            return {row[0] for row in self.conn.execute(f"SELECT race_id FROM races WHERE state IN ({placeholders})", tuple(states))}
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+def manifest_path(target):
+    """出力先（CSVファイル、またはParquetの出力先ディレクトリ）に対応する処理状況の記録ファイルのパス"""
+    return os.path.splitext(os.path.normpath(target))[0] + "_manifest.sqlite"
+
+def writer_target(writer):
+    """ライターの出力先（RaceWriterはCSVファイル、ParquetRaceWriterはディレクトリ）"""
+    return writer.dirpath if isinstance(writer, ParquetRaceWriter) else writer.filepath
+
+def open_manifest(writer):
+    """
+    ライターの出力先に対応するCrawlManifestを開き、出力先の内容と突き合わせる
+
+    記録ファイルは出力先ごとに分ける（同じOUTPUT_FILEでもCSVとParquetでは別の記録になる）。
+    - 取得・解析済みで書き出しが記録されていないのに出力先に含まれるレースは、
+      書き出しの途中で異常終了した可能性があるため出力先から削除する（再取得される）
+    - 書き出し済みと記録されているのに出力先に含まれないレース（出力ファイルを削除した場合など）は
+      failedに戻す（再取得される）
+    - 記録がないのに出力先に含まれるレース（記録を始める前のデータ）は書き出し済みとして記録する
+    """
+    manifest = CrawlManifest(manifest_path(writer_target(writer)))
+    unfinished = manifest.race_ids(("fetched", "parsed")) & writer.existing_race_ids
+    if unfinished:
+        writer.remove_races(unfinished)
+    missing = manifest.race_ids(("written",)) - writer.existing_race_ids
+    if missing:
+        logger.warning(f"{len(missing)} races recorded as written are missing from the output. They will be fetched again")
+        manifest.set_states(sorted(missing), "failed", "missing from output")
+    known = manifest.race_ids(("fetched", "parsed", "written", "nonexistent", "filtered", "failed"))
+    adopted = writer.existing_race_ids - known
+    if adopted:
+        logger.info(f"Recording {len(adopted)} races already in the output as written")
+        manifest.set_states(sorted(adopted), "written")
+    manifest.commit()
+    return manifest
+
+def _filter_key(distance_conditions, surface_conditions):
+    """filtered の状態と一緒に記録する条件の文字列"""
+    return json.dumps([sorted(distance_conditions or []), sorted(surface_conditions or [])], ensure_ascii=False)
+
+def discover_race_ids(target_years, target_kaisai_list, target_nichi_list, target_places, calendar,
+                      distance_conditions=None, surface_conditions=None):
+    """
+    開催カレンダーを使って、存在するレースのrace_idだけを順番に生成する
+
+    カレンダーに記録済みの開催日は記録されたレースだけを返す。未記録の開催日は1レース目を取得して確認し、
+    存在しなければその開催日を飛ばす。ある開催日が存在しなければ同じ開催回のそれ以降の日も、
+    1日目が存在しなければ同じ年・場所のそれ以降の開催回も存在しないものとして飛ばす。
+    距離・芝・ダートが記録済みで条件に合わないレースも取得せずに飛ばす。
+
+    Yields:
+        (race_id, content) のタプル。contentは確認のために取得済みのHTML（なければNone）
+    """
+    total_years = len(target_years)
+    total_kaisai = len(target_kaisai_list)
+    total_nichi = len(target_nichi_list)
+    last_kaisai = {} # {(年度, 場所): 存在しない最初の開催回}
+    last_nichi = {} # {(年度, 場所, 開催回): 存在しない最初の開催日目}
+
+    for year_index, target_year in enumerate(target_years, 1):
+        logger.info(f"Processing year: {target_year} ({year_index}/{total_years})")
+        for kaisai_index, target_kaisai in enumerate(target_kaisai_list, 1):
+            logger.info(f"Processing kaisai: {target_kaisai} ({kaisai_index}/{total_kaisai})")
+            for nichi_index, target_nichi in enumerate(target_nichi_list, 1):
+                logger.debug("Processing nichi: %s (%d/%d)", target_nichi, nichi_index, total_nichi)
+                for place_id_str in target_places:
+                    if int(target_kaisai) >= last_kaisai.get((target_year, place_id_str), 99):
+                        continue
+                    if int(target_nichi) >= last_nichi.get((target_year, place_id_str, target_kaisai), 99):
+                        continue
+
+                    day_key = f"{target_year}{place_id_str}{target_kaisai}{target_nichi}"
+                    races = calendar.known_races(day_key)
+                    content = None
+                    if races is None:
+                        # 未記録の開催日は1レース目で存在を確認する
+                        try:
+                            content = fetch_race_page(f"{day_key}01")
+                        except requests.exceptions.RequestException as e:
+                            logger.warning(f"Could not check day {day_key}: {e}")
+                        if content is not None and not page_exists(content):
+                            calendar.mark_day_missing(day_key)
+                            races = []
+                        else:
+                            races = [f"{race_num:02d}" for race_num in range(1, 13)] # 1レースから12レースまで
+
+                    if not races:
+                        logger.info(f"No races on day {day_key}. Skipping the rest of kaisai {target_kaisai}.")
+                        last_nichi[(target_year, place_id_str, target_kaisai)] = int(target_nichi)
+                        if int(target_nichi) == 1:
+                            last_kaisai[(target_year, place_id_str)] = int(target_kaisai)
+                        continue
+
+                    for race_num in races:
+                        race_id = f"{day_key}{race_num}"
+                        race_info = calendar.race_info(race_id)
+                        if race_info and _condition_mismatch(race_info.get("距離", ""), race_info.get("芝・ダート", ""),
+                                                             distance_conditions, surface_conditions):
+                            continue
+                        yield race_id, content if race_num == "01" else None
+        logger.info(f"Completed year: {target_year}")
+
+class CrawlPipeline:
+    """
+    取得 → 解析 → 書き込みの3段に分けてレースを処理するパイプライン
+
+    - 取得: max_workers 個のスレッドがページを取得し（rate_limited_requestで間隔はホストごとに全体として制限される）、
+      生HTMLを長さに上限のあるキューに入れる
+    - 解析: 生HTMLを parse_processes 個のプロセスに振り分けて並列に解析する
+    - 書き込み: 呼び出し元のスレッドだけがwriter（RaceWriter）に書き込む。解析の終わった順ではなくrace_idを受け取った順に書くため、
+      出力内容は逐次処理の場合と同じになる
+
+    未書き込みのレースは window 件までに制限しており、いずれかの段が詰まると前の段が待つため、
+    クロールの規模に関係なくメモリ使用量は一定に保たれる。
+
+    manifest（CrawlManifest）を指定すると各レースの処理状況を記録し、処理済みのレースは取得段に渡さない。
+    enricher（ProfileEnricher）を指定すると、書き込む前に出走馬と騎手のプロフィールを行に加える。
+    """
+
+    _DONE = object() # 各段の終了を伝える目印
+
+    def __init__(self, writer, distance_conditions=None, surface_conditions=None, max_workers=MAX_WORKERS,
+                 parse_processes=PARSE_PROCESSES, queue_size=PIPELINE_QUEUE_SIZE, calendar=None, offline=False,
+                 manifest=None, enricher=None):
+        self.writer = writer
+        self.distance_conditions = distance_conditions
+        self.surface_conditions = surface_conditions
+        self.max_workers = max_workers
+        self.parse_processes = parse_processes
+        self.calendar = calendar
+        self.offline = offline
+        self.manifest = manifest
+        self.enricher = enricher
+        self.filter_key = _filter_key(distance_conditions, surface_conditions)
+        self.engine = PARSER_ENGINE
+        self.fetch_queue = queue.Queue(maxsize=queue_size)
+        self.page_queue = queue.Queue(maxsize=queue_size)
+        # 結果のキューは window で件数が抑えられるので上限を設けない
+        self.result_queue = queue.Queue()
+        self.window = threading.BoundedSemaphore(queue_size * 3 + max_workers + max(parse_processes, 1) * 2)
+        self.parse_slots = threading.BoundedSemaphore(max(parse_processes, 1) * 2)
+
+    def run(self, race_ids):
+        """race_idのイテラブルを最後まで処理する"""
+        if self.parse_processes > 0:
+            # 取得スレッドの動作中にforkしないよう、spawnでプロセスを起動する
+            parse_pool = ProcessPoolExecutor(
+                self.parse_processes, mp_context=multiprocessing.get_context("spawn"), initializer=_init_parse_process,
+                initargs=(logger.getEffectiveLevel(), LOG_FORMAT, logger.disabled),
+            )
+        else:
+            parse_pool = ThreadPoolExecutor(1)
+        threads = [threading.Thread(target=self._feed, args=(race_ids,), daemon=True)]
+        threads += [threading.Thread(target=self._fetch, daemon=True) for _ in range(self.max_workers)]
+        threads.append(threading.Thread(target=self._dispatch, args=(parse_pool,), daemon=True))
+        try:
+            for thread in threads:
+                thread.start()
+            self._write()
+        finally:
+            parse_pool.shutdown(wait=True, cancel_futures=True)
+            if self.calendar is not None:
+                self.calendar.save()
+            if self.manifest is not None:
+                self.manifest.commit()
+
+    def _feed(self, race_ids):
+        """race_idに通し番号を付けて取得段に渡す"""
+        seq = 0
+        try:
+            for item in race_ids:
+                race_id, content = item if isinstance(item, tuple) else (item, None)
+                if self.manifest is not None and self.manifest.is_done(race_id, self.filter_key):
+                    if self.calendar is not None:
+                        self.calendar.record(race_id, self.manifest.state(race_id)[0] != "nonexistent")
+                    crawl_stats.inc("races", "already_done")
+                    continue
+                logger.debug("Processing race_id: %s", race_id)
+                self.window.acquire()
+                self.fetch_queue.put((seq, race_id, content))
+                seq += 1
+        except Exception as e:
+            # race_idの生成中の例外は書き込み段で送出する
+            self.result_queue.put((self._DONE, e))
+            return
+        finally:
+            for _ in range(self.max_workers):
+                self.fetch_queue.put(self._DONE)
+        self.result_queue.put((self._DONE, seq))
+
+    def _fetch(self):
+        """
+        ページを取得して解析段に渡す。取得に失敗したレースは結果を直接書き込み段に渡す
+
+        通信以外の例外（キャッシュ・処理状況の記録の失敗など）は書き込み段で送出する。
+        """
+        try:
+            while True:
+                item = self.fetch_queue.get()
+                if item is self._DONE:
+                    return
+                seq, race_id, content = item
+                if content is None:
+                    try:
+                        content = self._load_page(race_id)
+                    except requests.exceptions.RequestException as e:
+                        logger.error(f"Request failed for race {race_id}: {e}")
+                        crawl_stats.inc("errors", "request_failed")
+                        self._set_state(race_id, "failed", str(e))
+                        self.result_queue.put((seq, race_id, None, None, None))
+                        continue
+                if content is None:
+                    crawl_stats.inc("errors", "page_not_available")
+                    self._set_state(race_id, "failed", "page not available")
+                    self.result_queue.put((seq, race_id, None, None, None))
+                    continue
+                self._set_state(race_id, "fetched")
+                self.page_queue.put((seq, race_id, content))
+        except Exception as e:
+            self.result_queue.put((self._DONE, e))
+        finally:
+            self.page_queue.put(self._DONE)
+
+    def _set_state(self, race_id, state, detail=None):
+        # fetched以外は各レースの最後の状態（parsedはライターに渡したレース）なので件数を数える
+        if state != "fetched":
+            crawl_stats.inc("races", state)
+        if self.manifest is not None:
+            self.manifest.set_state(race_id, state, detail)
+
+    def _load_page(self, race_id):
+        if not self.offline:
+            return fetch_race_page(race_id)
+        with crawl_stats.timer("fetch"):
+            cached = get_page_cache().get(race_id)
+        crawl_stats.inc("cache_lookups", "hit" if cached else "miss")
+        return cached[0] if cached else None
+
+    def _dispatch(self, parse_pool):
+        """生HTMLを解析プロセスに渡す。解析中の件数が上限に達したら空くまで待つ"""
+        remaining = self.max_workers
+        try:
+            while remaining:
+                item = self.page_queue.get()
+                if item is self._DONE:
+                    remaining -= 1
+                    continue
+                seq, race_id, content = item
+                self.parse_slots.acquire()
+                try:
+                    future = parse_pool.submit(
+                        _parse_page_task, content, race_id, self.distance_conditions, self.surface_conditions, self.engine
+                    )
+                except BaseException:
+                    self.parse_slots.release()
+                    raise
+                future.add_done_callback(lambda f, seq=seq, race_id=race_id, exists=page_exists(content): self._parsed(f, seq, race_id, exists))
+        except Exception as e:
+            # 解析プロセスのプールが壊れた場合（BrokenProcessPool）など。書き込み段で送出する
+            self.result_queue.put((self._DONE, e))
+
+    def _parsed(self, future, seq, race_id, exists):
+        self.parse_slots.release()
+        try:
+            (race_info, data), stats = future.result()
+        except Exception as e:
+            # 解析プロセスが異常終了した場合など。書き込み段で送出する
+            self.result_queue.put((self._DONE, e))
+            return
+        if stats:
+            crawl_stats.merge(stats)
+        self.result_queue.put((seq, race_id, exists, data, race_info))
+
+    def _write(self):
+        """結果をrace_idを受け取った順に並べ直してCSVに書き込む"""
+        buffered = {}
+        next_seq = 0
+        total = None
+        while total is None or next_seq < total:
+            item = self.result_queue.get()
+            if item[0] is self._DONE:
+                if isinstance(item[1], Exception):
+                    raise item[1]
+                total = item[1]
+                continue
+            buffered[item[0]] = item[1:]
+            while next_seq in buffered:
+                race_id, exists, data, race_info = buffered.pop(next_seq)
+                if self.calendar is not None and exists is not None:
+                    self.calendar.record(race_id, exists, race_info)
+                self._write_race(race_id, exists, data, race_info)
+                next_seq += 1
+                self.window.release()
+
+    def _write_race(self, race_id, exists, data, race_info):
+        """条件に合うレースをライターに渡し、処理状況を記録する"""
+        if exists is None: # 取得・解析に失敗したレース（取得段で記録済み）
+            return
+        if exists is False:
+            self._set_state(race_id, "nonexistent")
+            return
+        if not data:
+            if race_info and _condition_mismatch(race_info["距離"], race_info["芝・ダート"],
+                                                 self.distance_conditions, self.surface_conditions):
+                self._set_state(race_id, "filtered", self.filter_key)
+            else:
+                crawl_stats.inc("errors", "no_result_rows")
+                self._set_state(race_id, "failed", "no result rows")
+            return
+        # === 条件フィルタリング ===
+        filtered_data = filter_race_by_conditions(data, self.distance_conditions, self.surface_conditions)
+        if filtered_data and self.enricher is not None and race_id not in self.writer.existing_race_ids:
+            with crawl_stats.timer("enrich"):
+                filtered_data = self.enricher.enrich(filtered_data)
+        if not filtered_data:
+            self._set_state(race_id, "filtered", self.filter_key)
+        elif race_id in self.writer.existing_race_ids:
+            crawl_stats.inc("races", "duplicate")
+            if self.manifest is not None:
+                self.manifest.set_state(race_id, "written") # 既に出力ファイルに含まれていた
+        else:
+            # write_raceの中で書き出した場合はその時点でライターからwrittenが記録されるため、parsedは先に記録する
+            self._set_state(race_id, "parsed")
+            self.writer.write_race(filtered_data) # バッファに追加し、まとめて書き出す
+
+def _init_parse_process(level, fmt, disabled):
+    """解析プロセスのログを親プロセスと同じ設定にする（spawnで起動したプロセスは設定を引き継がない）"""
+    configure_logging(level, fmt)
+    logger.disabled = disabled
+
+def _parse_page_task(content, race_id, distance_conditions, surface_conditions, engine):
+    """
+    解析プロセスで実行する処理（プロセス間で受け渡せるようモジュールの関数にしている）
+
+    (_parse_race_pageの戻り値, 集計した値) を返す。解析プロセスで集計した値は親プロセスに返して合算する
+    （スレッドで解析する場合は親プロセスのcrawl_statsに直接記録されるのでNone）。
+    """
+    with crawl_stats.timer("parse"):
+        result = _parse_race_page(content, race_id, distance_conditions, surface_conditions, engine)
+    return result, crawl_stats.drain() if multiprocessing.parent_process() is not None else None
+
+def crawl_races(race_ids, output_file, distance_conditions=None, surface_conditions=None, max_workers=MAX_WORKERS, calendar=None):
+    """
+    race_idのデータを取得・解析し、条件に合うレースをCSVに追記する（処理の流れはCrawlPipelineを参照）
+
+    Args:
+        race_ids: 取得するrace_id、または (race_id, 取得済みのHTML) のタプルのイテラブル
+        output_file: 出力先のCSVファイル（OUTPUT_FORMATが"parquet"の場合は出力先ディレクトリの名前に使う）
+        distance_conditions: 距離条件のリスト
+        surface_conditions: 芝・ダート条件のリスト
+        max_workers: ページを取得するスレッド数
+        calendar: レースの有無を記録するRaceCalendar（Noneなら記録しない）
+    """
+    _run_pipeline(race_ids, output_file, distance_conditions, surface_conditions, max_workers=max_workers, calendar=calendar)
+
+def _run_pipeline(race_ids, output_file, distance_conditions, surface_conditions, shard=False, **pipeline_options):
+    """
+    出力ファイルのライター（と処理状況の記録）を開いてCrawlPipelineを実行し、終了時に処理状況のレポートを保存する
+
+    shardがTrueの場合はシャードの出力ファイル（CSV）にだけ書き込み、データベースと集計はmerge_shardsで更新する。
+    """
+    crawl_stats.reset()
+    manifest = profile_cache = None
+    if shard:
+        database = features = None
+        writer = RaceWriter(output_file, fieldnames=csv_fieldnames())
+        report_file = os.path.splitext(output_file)[0] + "_report.json"
+    else:
+        database = open_database(output_file)
+        features = open_feature_store(output_file)
+        writer = open_race_writer(output_file, database=database, features=features)
+        report_file = REPORT_FILE
+    try:
+        if ENRICH_PROFILES:
+            # 書き出す列にプロフィールの列がなければ（Parquet・列を加える前からあるCSV）取得しても捨てられるため取得しない
+            if set(PROFILE_FIELDNAMES) <= set(getattr(writer, "fieldnames", ())):
+                profile_cache = ProfileCache(PROFILE_CACHE_FILE) if PROFILE_CACHE_FILE else None
+                # オフラインの場合はプロフィールもキャッシュにあるものだけを使う
+                pipeline_options["enricher"] = ProfileEnricher(profile_cache, offline=pipeline_options.get("offline", False))
+            else:
+                logger.warning(f"ENRICH_PROFILES is set but the output for {output_file} has no profile columns. "
+                               "Profiles will not be fetched (write to a new CSV to add them).")
+        if USE_MANIFEST:
+            manifest = open_manifest(writer)
+            writer.on_flush = manifest.mark_written
+        CrawlPipeline(writer, distance_conditions, surface_conditions, manifest=manifest, **pipeline_options).run(race_ids)
+    finally:
+        writer.close()
+        if manifest is not None:
+            manifest.close()
+        for store in (database, features, profile_cache):
+            if store is not None:
+                store.close()
+        logger.info(crawl_stats.summary())
+        if rate_limiter.rates():
+            logger.info("Request rates: " + ", ".join(f"{host} {rate:.3f} req/s" for host, rate in rate_limiter.rates().items()))
+        if report_file:
+            crawl_stats.write_report(report_file)
+            logger.info(f"Crawl report saved to {report_file}")
+
+def reparse_from_cache(output_file, distance_conditions=None, surface_conditions=None):
+    """
+    HTMLキャッシュに保存済みのページだけを解析し直してCSVを作り直す（ネットワークには一切アクセスしない）
+
+    解析処理を修正した後にデータを作り直す用途を想定している。output_fileに既に含まれるレースは書き込まないため、
+    作り直す場合は既存のファイル（と処理状況の記録）を削除するか別のファイル名を指定すること。
+    """
+    cache = get_page_cache()
+    if cache is None:
+        logger.error("CACHE_DIR is not set. Nothing to reparse.")
+        return
+    race_ids = cache.race_ids()
+    logger.info(f"Reparsing {len(race_ids)} cached races...")
+    # 取得段がキャッシュを読むだけのパイプラインで、解析を複数プロセスに分散する
+    _run_pipeline(race_ids, output_file, distance_conditions, surface_conditions, offline=True)
+
+class ShardLeaseLost(Exception):
+    """処理中のシャードの貸出期間を延長できず、他のワーカーに貸し出された可能性がある"""
+
+class ShardQueue:
+    """
+    シャードを複数のワーカーに貸し出す作業キュー（SQLite）
+
+    シャードは年度・場所・開催回の組み合わせ（shard_idはrace_idの先頭8桁）で、その開催回の開催日目のリストを持つ。
+    状態は pending（未処理）, leased（貸出中）, done（取得済み）, merged（出力ファイルに統合済み）, failed（失敗）のいずれか。
+    claim()は pending のシャードか、貸出期間の切れた leased のシャードを1つだけ貸し出す（BEGIN IMMEDIATEで
+    他のプロセスと同時に同じシャードを借りないようにする）。貸し出したワーカー以外はrenew・complete・releaseできない。
+    貸出期間の切れた leased のシャードのうち、SHARD_MAX_ATTEMPTS回貸し出したものはclaim()の際に failed にする。
+    別のマシンからSHARD_DIRを共有して使えるよう、ジャーナルはWAL（同じマシンの共有メモリが必要）ではなく既定のものを使う。
+    """
+
+    def __init__(self, filepath, lease_seconds=SHARD_LEASE_SECONDS):
+        self.filepath = filepath
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        # トランザクションは明示的に開始する（BEGIN IMMEDIATEで書き込みロックを取ってから貸し出すシャードを選ぶ）
+        self.conn = sqlite3.connect(filepath, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=DELETE") # WALで作成済みのファイルも既定のジャーナルに戻す
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_id TEXT PRIMARY KEY,
+                year TEXT NOT NULL,
+                place TEXT NOT NULL,
+                kaisai TEXT NOT NULL,
+                nichi TEXT NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                detail TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS shards_state ON shards (state);
+        """)
+
+    def add_shards(self, target_years, target_kaisai_list, target_nichi_list, target_places, reset_states=()):
+        """
+        年度・場所・開催回の組み合わせをシャードとして追加する。追加した数を返す
+
+        追加済みのシャードのうち、reset_states（例: ("failed",)）の状態のものと、今年以降の merged のもの
+        （後から開催されるレースがある）は、失敗の回数を0にして pending に戻す（取得済みのレースは取得し直さない）。
+        それ以外の追加済みのシャードはそのまま。
+        """
+        now = time.time()
+        nichi = json.dumps(list(target_nichi_list))
+        shards = [(f"{year}{place}{kaisai}", str(year), place, kaisai, nichi, now)
+                  for year in target_years for place in target_places for kaisai in target_kaisai_list]
+        states = ", ".join("?" for _ in reset_states) or "NULL"
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self.conn.total_changes
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO shards (shard_id, year, place, kaisai, nichi, state, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, 'pending', ?)", shards,
+                )
+                added = self.conn.total_changes - before
+                self.conn.executemany(
+                    "UPDATE shards SET state = 'pending', worker = NULL, lease_expires = NULL, attempts = 0, detail = NULL, "
+                    f"nichi = ?, updated_at = ? WHERE shard_id = ? AND (state IN ({states}) OR (state = 'merged' AND year >= ?))",
+                    [(nichi, now, shard[0], *reset_states, str(datetime.now().year)) for shard in shards],
+                )
+                requeued = self.conn.total_changes - before - added
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if requeued:
+            logger.info(f"Requeued {requeued} shards")
+        return added
+
+    def claim(self, worker_id):
+        """シャードを1つ借りて辞書で返す。貸し出せるシャードがなければNone"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 最後の貸し出しでも返却されずに期限が切れたシャード（ワーカーが異常終了した場合など）
+                self.conn.execute(
+                    "UPDATE shards SET state = 'failed', worker = NULL, lease_expires = NULL, "
+                    "detail = COALESCE(detail, 'lease expired'), updated_at = ? "
+                    "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, SHARD_MAX_ATTEMPTS),
+                )
+                row = self.conn.execute(
+                    "SELECT * FROM shards WHERE (state = 'pending' OR (state = 'leased' AND lease_expires < ?)) "
+                    "AND attempts < ? ORDER BY shard_id LIMIT 1", (now, SHARD_MAX_ATTEMPTS),
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE shards SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                        "updated_at = ? WHERE shard_id = ?", (worker_id, now + self.lease_seconds, now, row["shard_id"]),
+                    )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        shard = dict(row)
+        shard["nichi"] = json.loads(shard["nichi"])
+        return shard
+
+    def _update_leased(self, shard_id, worker_id, assignments, params):
+        """worker_idが借りているシャードだけを更新する。更新できたらTrue"""
+        with self.lock:
+            cursor = self.conn.execute(
+                f"UPDATE shards SET {assignments}, updated_at = ? WHERE shard_id = ? AND worker = ? AND state = 'leased'",
+                (*params, time.time(), shard_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def renew(self, shard_id, worker_id):
+        """貸出期間を延長する。既に他のワーカーに貸し出されていた場合はFalse"""
+        return self._update_leased(shard_id, worker_id, "lease_expires = ?", (time.time() + self.lease_seconds,))
+
+    def complete(self, shard_id, worker_id):
+        return self._update_leased(shard_id, worker_id, "state = 'done', lease_expires = NULL, detail = NULL", ())
+
+    def release(self, shard_id, worker_id, detail=None):
+        """失敗したシャードを返却する（SHARD_MAX_ATTEMPTS回失敗したシャードはfailedにする）"""
+        return self._update_leased(
+            shard_id, worker_id,
+            "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, lease_expires = NULL, detail = ?",
+            (SHARD_MAX_ATTEMPTS, detail),
+        )
+
+    def mark_merged(self, shard_id):
+        with self.lock:
+            self.conn.execute("UPDATE shards SET state = 'merged', updated_at = ? WHERE shard_id = ?", (time.time(), shard_id))
+
+    def shard_ids(self, states):
+        """指定した状態のshard_idのリスト（昇順）"""
+        placeholders = ", ".join("?" for _ in states)
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                f"SELECT shard_id FROM shards WHERE state IN ({placeholders}) ORDER BY shard_id", tuple(states))]
+
+    def counts(self):
+        """{状態: シャード数}"""
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall())
+
+    def close(self):
+        self.conn.close()
+
+def shard_output_path(shard_id):
+    """シャードの出力ファイル（処理状況の記録とレポートも同じ名前で隣に作られる）"""
+    return f"{SHARD_DIR}{shard_id}.csv"
+
+def _shard_calendar_path(shard_id):
+    return f"{SHARD_DIR}{shard_id}_calendar.json"
+
+def run_shard_worker(queue_file=SHARD_QUEUE_FILE, distance_conditions=None, surface_conditions=None, worker_id=None,
+                     parse_processes=PARSE_PROCESSES):
+    """
+    作業キューからシャードを借りて取得し、シャードごとの出力ファイルに書き込む（貸し出せるシャードがなくなるまで繰り返す）
+
+    別のマシンから参加する場合もこの関数を実行する。リクエスト間隔の制限はプロセスごとに行われる。
+    シャードの出力ファイルは出力ファイルと同じく処理状況を記録するため、異常終了したシャードを
+    別のワーカーが借りた場合も取得済みのレースは取得し直さない。
+
+    Returns:
+        取得を終えたシャードの数
+    """
+    if not logger.handlers:
+        configure_logging()
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    shard_queue = ShardQueue(queue_file)
+    completed = 0
+    try:
+        while True:
+            shard = shard_queue.claim(worker_id)
+            if shard is None:
+                break
+            shard_id = shard["shard_id"]
+            logger.info(f"Worker {worker_id} claimed shard {shard_id} (attempt {shard['attempts'] + 1})")
+            try:
+                _crawl_shard(shard_queue, shard, worker_id, distance_conditions, surface_conditions, parse_processes)
+            except Exception as e:
+                logger.error(f"Shard {shard_id} failed on worker {worker_id}: {e}")
+                shard_queue.release(shard_id, worker_id, f"{e.__class__.__name__}: {e}")
+                continue
+            if shard_queue.complete(shard_id, worker_id):
+                completed += 1
+            else:
+                logger.warning(f"Shard {shard_id} was leased to another worker before {worker_id} completed it")
+    finally:
+        shard_queue.close()
+    logger.info(f"Worker {worker_id} finished {completed} shards")
+    return completed
+
+def _crawl_shard(shard_queue, shard, worker_id, distance_conditions, surface_conditions, parse_processes):
+    """1つのシャードを取得する。処理中は別のスレッドで貸出期間を延長し、延長できなくなったら取得を止める"""
+    shard_id = shard["shard_id"]
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def keep_lease():
+        try:
+            while not stop.wait(shard_queue.lease_seconds / 3):
+                if not shard_queue.renew(shard_id, worker_id):
+                    lost.set()
+                    return
+        except Exception as e:
+            # 延長できたかわからない場合も、他のワーカーに貸し出された可能性があるため取得を止める
+            logger.error(f"Could not renew the lease on shard {shard_id}: {e}")
+            lost.set()
+
+    def leased(race_ids):
+        for item in race_ids:
+            if lost.is_set():
+                raise ShardLeaseLost(f"Lease on shard {shard_id} was lost")
+            yield item
+
+    calendar = None
+    if CALENDAR_FILE:
+        # 共有のカレンダーはmerge_shardsだけが書き込む。シャードの分だけを写したカレンダーを使う
+        calendar = RaceCalendar(_shard_calendar_path(shard_id))
+        shared = RaceCalendar(CALENDAR_FILE)
+        for key, day in shared.days.items():
+            if key.startswith(shard_id):
+                calendar.days.setdefault(key, day)
+        race_ids = discover_race_ids([shard["year"]], [shard["kaisai"]], shard["nichi"], [shard["place"]], calendar,
+                                     distance_conditions, surface_conditions)
+    else:
+        race_ids = generate_race_ids([shard["year"]], [shard["kaisai"]], shard["nichi"], [shard["place"]])
+
+    keeper = threading.Thread(target=keep_lease, daemon=True)
+    keeper.start()
+    try:
+        _run_pipeline(leased(race_ids), shard_output_path(shard_id), distance_conditions, surface_conditions, shard=True,
+                      calendar=calendar, parse_processes=parse_processes)
+    finally:
+        stop.set()
+        keeper.join()
+
+def merge_shards(output_file, queue_file=SHARD_QUEUE_FILE):
+    """
+    取得を終えたシャードの出力ファイルを出力ファイルに統合する（データベース・集計・開催カレンダーも更新する）
+
+    ライターは出力ファイルに含まれるrace_idを書き込まないため、途中で中断しても繰り返し実行できる。
+    統合したシャードはmergedにする。
+    """
+    shard_queue = ShardQueue(queue_file)
+    shard_ids = shard_queue.shard_ids(("done",))
+    database = open_database(output_file)
+    features = open_feature_store(output_file)
+    writer = open_race_writer(output_file, database=database, features=features)
+    calendar = RaceCalendar(CALENDAR_FILE) if CALENDAR_FILE else None
+    try:
+        for shard_id in shard_ids:
+            path = shard_output_path(shard_id)
+            races = {}
+            if os.path.isfile(path):
+                with open(path, encoding="utf-8-sig", newline="") as f:
+                    for row in csv.DictReader(f):
+                        races.setdefault(row["race_id"], []).append(row)
+            # シャードの行はクリーニング済みだが、clean_dataは同じ値に何度適用しても変わらないためそのまま渡せる
+            for race_id in sorted(races):
+                writer.write_race(races[race_id])
+            writer.flush()
+            if calendar is not None and os.path.isfile(_shard_calendar_path(shard_id)):
+                calendar.days.update(RaceCalendar(_shard_calendar_path(shard_id)).days)
+                calendar.dirty = True
+                calendar.save()
+            shard_queue.mark_merged(shard_id)
+            logger.info(f"Merged shard {shard_id} ({len(races)} races) into {output_file}")
+    finally:
+        writer.close()
+        for store in (database, features):
+            if store is not None:
+                store.close()
+        counts = shard_queue.counts()
+        shard_queue.close()
+    logger.info(f"Shards: {counts}")
+    return counts
+
+def crawl_sharded(target_years, target_kaisai_list, target_nichi_list, target_places, output_file,
+                  distance_conditions=None, surface_conditions=None, workers=SHARD_WORKERS):
+    """
+    シャードを作業キューに追加し、workers個のワーカープロセスで取得してから出力ファイルに統合する
+
+    既に作業キューにあるシャードは追加し直さないため、中断した場合は同じ設定で再実行すると残りのシャードだけを取得する。
+    失敗したシャードと今年以降の統合済みのシャードは再実行の際に取得し直す（取得済みのレースは取得しない）。
+    """
+    shard_queue = ShardQueue(SHARD_QUEUE_FILE)
+    added = shard_queue.add_shards(target_years, target_kaisai_list, target_nichi_list, target_places,
+                                   reset_states=("failed",))
+    logger.info(f"Added {added} shards to {SHARD_QUEUE_FILE}: {shard_queue.counts()}")
+    shard_queue.close()
+
+    # 解析プロセスはワーカーで分け合う
+    parse_processes = max(1, PARSE_PROCESSES // max(workers, 1)) if PARSE_PROCESSES > 0 else 0
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_shard_worker, args=(SHARD_QUEUE_FILE, distance_conditions, surface_conditions),
+                        kwargs={"parse_processes": parse_processes}, name=f"shard-worker-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            logger.warning(f"{process.name} exited with code {process.exitcode}")
+    return merge_shards(output_file)
 
 def main():
     """メイン処理: 指定された範囲のレースIDのデータを取得しCSVに保存する"""
@@ -381,7 +2762,29 @@ def main():
        - 芝の短距離レースのみ: distance_conditions=["1200", "1400"], surface_conditions=["芝"]
        - ダートの中距離レースのみ: distance_conditions=["1600", "1800"], surface_conditions=["ダ"]
        - 特定開催回数のみ: target_kaisai_list = ["01", "05"]  # 1回と5回開催のみ
+
+    6. 実行モードの指定:
+       - mode = "crawl"  # netkeiba.comから取得する（取得したページはCACHE_DIRにキャッシュされる）
+       - mode = "reparse"  # キャッシュ済みのページだけを解析し直す（ネットワークにはアクセスしない）
+       - mode = "sharded"  # 年度・場所・開催回ごとのシャードに分け、SHARD_WORKERS個のプロセスで取得してから統合する
+                           # 別のマシンからは run_shard_worker() で参加し、最後に merge_shards(OUTPUT_FILE) で統合する
+       - 中断した場合は同じ設定で再実行すると続きから再開する（USE_MANIFEST = True の場合。書き込み済みのレースは取得しない）
+
+    7. 出力形式の指定（モジュール先頭の OUTPUT_FORMAT・ENRICH_PROFILES）:
+       - OUTPUT_FORMAT = "csv"  # CSVと.txtに出力する
+       - OUTPUT_FORMAT = "parquet"  # 型付きのParquetで年度/場id/芝・ダートごとに出力する（read_parquet_datasetで読み込む）
+       - ENRICH_PROFILES = True  # 馬の血統・通算成績と騎手の成績の列をCSVに加える（新しいCSVに出力する場合に使う）
+
+    8. ログとレポート（モジュール先頭の LOG_LEVEL・LOG_FORMAT・REPORT_FILE）:
+       - LOG_LEVEL = "DEBUG"  # レースごとの取得・待機・スキップも出力する
+       - LOG_FORMAT = "json"  # 1行1つのJSONで出力する
+       - 終了時に REPORT_FILE（JSON）と同名の .prom（Prometheusのテキスト形式）に段ごとの処理時間・待機時間・件数を保存する
     """
+
+    configure_logging()
+
+    # === 実行モード ===
+    mode = "crawl"
     
     # === 年度指定（単年または複数年度） ===
     # 方法1: 単年指定（従来の方法）
@@ -482,41 +2885,30 @@ def main():
     # surface_conditions = None
 
     # 条件の表示
-    print(f"[INFO] Target years: {target_years}")
-    print(f"[INFO] Target kaisai: {target_kaisai_list}")
-    print(f"[INFO] Target nichi: {target_nichi_list}")
-    print(f"[INFO] Distance conditions: {distance_conditions if distance_conditions else 'All distances'}")
-    print(f"[INFO] Surface conditions: {surface_conditions if surface_conditions else 'All surfaces'}")
+    logger.info(f"Target years: {target_years}")
+    logger.info(f"Target kaisai: {target_kaisai_list}")
+    logger.info(f"Target nichi: {target_nichi_list}")
+    logger.info(f"Distance conditions: {distance_conditions if distance_conditions else 'All distances'}")
+    logger.info(f"Surface conditions: {surface_conditions if surface_conditions else 'All surfaces'}")
 
-    all_race_data = [] # すべてのレースデータを一旦メモリに貯める場合 (非推奨：メモリ使用量大)
-
-    # === 複数年度・複数開催回数・複数開催日目に対応したループ処理 ===
-    total_years = len(target_years)
-    total_kaisai = len(target_kaisai_list)
-    total_nichi = len(target_nichi_list)
-    
-    for year_index, target_year in enumerate(target_years, 1):
-        print(f"[INFO] Processing year: {target_year} ({year_index}/{total_years})")
-        for kaisai_index, target_kaisai in enumerate(target_kaisai_list, 1):
-            print(f"[INFO] Processing kaisai: {target_kaisai} ({kaisai_index}/{total_kaisai})")
-            for nichi_index, target_nichi in enumerate(target_nichi_list, 1):
-                print(f"[INFO] Processing nichi: {target_nichi} ({nichi_index}/{total_nichi})")
-                for place_id_str in target_places:
-                    for race_num in range(1, 13): # 1レースから12レースまで
-                        race_id = f"{target_year}{place_id_str}{target_kaisai}{target_nichi}{race_num:02d}"
-                        print(f"[INFO] Processing race_id: {race_id}")
-                        data = get_race_data(race_id)
-                        if data:
-                            # === 条件フィルタリング ===
-                            filtered_data = filter_race_by_conditions(data, distance_conditions, surface_conditions)
-                            if filtered_data:
-                                append_to_csv(filtered_data, OUTPUT_FILE) # 取得ごとにCSVに追記
-                            # all_race_data.extend(data) # メモリに貯める場合
-        print(f"[INFO] Completed year: {target_year}")
-
-    # # メモリに貯めたデータを最後に一括で書き込む場合 (メモリ注意)
-    # if all_race_data:
-    #     append_to_csv(all_race_data, OUTPUT_FILE)
+    if mode == "reparse":
+        # キャッシュ済みのページから作り直す（年度・開催の指定は使わない）
+        reparse_from_cache(OUTPUT_FILE, distance_conditions, surface_conditions)
+    elif mode == "sharded":
+        crawl_sharded(target_years, target_kaisai_list, target_nichi_list, target_places, OUTPUT_FILE,
+                      distance_conditions, surface_conditions)
+    else:
+        # === 複数年度・複数開催回数・複数開催日目に対応したループ処理 ===
+        # 取得は MAX_WORKERS 件まで並行して行い、CSVへの書き込みはrace_idの順番通りに行う
+        if CALENDAR_FILE:
+            # 開催カレンダーで存在するレースだけを取得する
+            calendar = RaceCalendar(CALENDAR_FILE)
+            race_ids = discover_race_ids(target_years, target_kaisai_list, target_nichi_list, target_places, calendar,
+                                         distance_conditions, surface_conditions)
+        else:
+            calendar = None
+            race_ids = generate_race_ids(target_years, target_kaisai_list, target_nichi_list, target_places)
+        crawl_races(race_ids, OUTPUT_FILE, distance_conditions, surface_conditions, calendar=calendar)
 
     print(f"[完了] データを {OUTPUT_FILE} に保存しました (または追記しました)。")
 
@@ -0,0 +1,5 @@
+# テストからリポジトリ直下のモジュール（keiba_scraping.py など）を読み込めるようにする
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
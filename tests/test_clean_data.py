@@ -0,0 +1,27 @@
+# clean_data_batch が clean_data と同じ結果を返すことを確認するテスト
+import csv
+import os
+
+import pytest
+
+import keiba_scraping as ks
+
+# clean_data前の行（取得済みのデータを元に戻した3レース分と、変換できない値やNBSPを含む行）
+FIXTURE_CSV = os.path.join(os.path.dirname(__file__), "fixtures", "clean_data_rows.csv")
+
+@pytest.fixture
+def rows():
+    with open(FIXTURE_CSV, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+def test_clean_data_batch_matches_clean_data(rows):
+    assert ks.clean_data_batch(rows) == ks.clean_data(rows)
+
+def test_clean_data_batch_does_not_modify_input(rows):
+    original = [row.copy() for row in rows]
+    ks.clean_data_batch(rows)
+    assert rows == original
+
+def test_clean_data_batch_without_numpy(rows, monkeypatch):
+    monkeypatch.setattr(ks, "np", None)
+    assert ks.clean_data_batch(rows) == ks.clean_data(rows)
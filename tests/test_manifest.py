@@ -0,0 +1,87 @@
+# 処理状況の記録（CrawlManifest）によって、取得し直しても同じレースを取得しないことを確認するテスト
+import csv
+import os
+
+import pytest
+
+import keiba_benchmark as kb
+import keiba_scraping as ks
+
+FIXTURE_CSV = os.path.join(os.path.dirname(__file__), "fixtures", "clean_data_rows.csv")
+
+@pytest.fixture
+def pages():
+    """フィクスチャのCSVの各レースから作ったレースページの (race_id, HTML) のリスト"""
+    races = {}
+    with open(FIXTURE_CSV, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            races.setdefault(row["race_id"], []).append(row)
+    return [(race_id, kb.synthetic_race_page(rows)) for race_id, rows in races.items()]
+
+@pytest.fixture
+def requests(pages, monkeypatch):
+    """fetch_race_pageをフィクスチャのページを返す関数に置き換え、取得したrace_idのリストを返す"""
+    monkeypatch.setattr(ks.logger, "disabled", True)
+    fetched = []
+    contents = dict(pages)
+
+    def fetch_race_page(race_id):
+        fetched.append(race_id)
+        return contents.get(race_id)
+    monkeypatch.setattr(ks, "fetch_race_page", fetch_race_page)
+    return fetched
+
+def crawl(writer, race_ids):
+    """書き出しを1レースごとに行うライターと処理状況の記録を使ってクロールし、記録を返す"""
+    manifest = ks.open_manifest(writer)
+    writer.on_flush = manifest.mark_written
+    try:
+        ks.CrawlPipeline(writer, max_workers=1, parse_processes=0, manifest=manifest).run(race_ids)
+    finally:
+        writer.close()
+        manifest.commit()
+    return manifest
+
+def csv_race_ids(output_file):
+    with open(output_file, encoding="utf-8-sig", newline="") as f:
+        return {row["race_id"] for row in csv.DictReader(f)}
+
+def test_races_flushed_inline_stay_written(tmp_path, pages, requests):
+    output_file = str(tmp_path / "races.csv")
+    race_ids = [race_id for race_id, _ in pages]
+    manifest = crawl(ks.RaceWriter(output_file, flush_rows=1), race_ids)
+    assert manifest.race_ids(("written",)) == set(race_ids)
+    manifest.close()
+    assert len(requests) == len(race_ids)
+
+    # 2回目は全て処理済みなので、ページを取得しない
+    crawl(ks.RaceWriter(output_file, flush_rows=1), race_ids).close()
+    assert len(requests) == len(race_ids)
+    assert csv_race_ids(output_file) == set(race_ids)
+
+def test_races_missing_from_output_are_fetched_again(tmp_path, pages, requests):
+    output_file = str(tmp_path / "races.csv")
+    race_ids = [race_id for race_id, _ in pages]
+    crawl(ks.RaceWriter(output_file, flush_rows=1), race_ids).close()
+
+    # 記録を残したまま出力ファイルを削除すると、書き出し済みのレースも取得し直して作り直す
+    for path in (output_file, output_file.replace(".csv", ".txt"), f"{output_file}.flushed"):
+        os.remove(path)
+    manifest = crawl(ks.RaceWriter(output_file, flush_rows=1), race_ids)
+    assert manifest.race_ids(("written",)) == set(race_ids)
+    manifest.close()
+    assert requests == race_ids * 2
+    assert csv_race_ids(output_file) == set(race_ids)
+
+def test_csv_and_parquet_outputs_have_separate_manifests(tmp_path, pages, requests):
+    pytest.importorskip("pyarrow")
+    output_file = str(tmp_path / "races.csv")
+    race_ids = [race_id for race_id, _ in pages]
+    crawl(ks.RaceWriter(output_file, flush_rows=1), race_ids).close()
+
+    writer = ks.ParquetRaceWriter(str(tmp_path / "races_parquet"), flush_rows=1)
+    assert ks.manifest_path(ks.writer_target(writer)) != ks.manifest_path(output_file)
+    crawl(writer, race_ids).close()
+    assert requests == race_ids * 2
+    table = ks.read_parquet_dataset(str(tmp_path / "races_parquet"), columns=["race_id"])
+    assert set(table.column("race_id").to_pylist()) == set(race_ids)
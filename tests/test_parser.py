@@ -0,0 +1,37 @@
+# 解析エンジン（bs4・lxml）が同じ行を返すことを確認するテスト
+import csv
+import os
+
+import pytest
+
+import keiba_benchmark as kb
+import keiba_scraping as ks
+
+FIXTURE_CSV = os.path.join(os.path.dirname(__file__), "fixtures", "clean_data_rows.csv")
+
+def fixture_races():
+    races = {}
+    with open(FIXTURE_CSV, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            races.setdefault(row["race_id"], []).append(row)
+    return races
+
+def fixture_pages():
+    """(race_id, HTML) のリスト。NBSPを含むレースと、レース情報のないページも加える"""
+    races = fixture_races()
+    pages = [(race_id, kb.synthetic_race_page(rows)) for race_id, rows in races.items()]
+    race_id, rows = next(iter(races.items()))
+    nbsp_rows = [dict(row, レース名="3歳\xa0未勝利", 走破時間="1:34.5\xa0", 騎手="横山\xa0武史") for row in rows]
+    pages.append(("202405019901", kb.synthetic_race_page([dict(row, race_id="202405019901") for row in nbsp_rows])))
+    pages.append(("202405019999", kb.missing_race_page()))
+    return pages
+
+@pytest.mark.parametrize("race_id, content", fixture_pages(), ids=lambda value: value if isinstance(value, str) else "")
+def test_engines_return_identical_rows(race_id, content, monkeypatch):
+    monkeypatch.setattr(ks.logger, "disabled", True)
+    assert ks.parse_race_page(content, race_id, engine="bs4") == ks.parse_race_page(content, race_id, engine="lxml")
+
+def test_nbsp_page_is_parsed():
+    race_id, content = fixture_pages()[-2]
+    rows = ks.parse_race_page(content, race_id, engine="lxml")
+    assert rows and rows[0]["レース名"] == "3歳\xa0未勝利" and "?" not in rows[0]["天気"]
@@ -0,0 +1,33 @@
+# 馬・騎手のプロフィールの取得（ProfileEnricher）のテスト
+import pytest
+
+import keiba_scraping as ks
+
+class StubResponse:
+    def __init__(self, content):
+        self.content = content
+
+class StubTransport:
+    """URLに関係なく同じ内容を返すtransport"""
+
+    def __init__(self, content):
+        self.content = content
+        self.urls = []
+
+    def fetch(self, url):
+        self.urls.append(url)
+        return StubResponse(self.content)
+
+@pytest.mark.parametrize("content", [b"", b"  \n\t ", b"<html></html>"])
+def test_unparsable_profile_page_is_counted_as_failed(content, monkeypatch):
+    monkeypatch.setattr(ks.logger, "disabled", True)
+    transport = StubTransport(content)
+    monkeypatch.setattr(ks, "transport", transport)
+    ks.crawl_stats.reset()
+    rows = ks.ProfileEnricher().enrich([{"race_id": "202405010101", "馬id": "2021105555", "騎手id": "01170"}])
+    assert len(transport.urls) == 2
+    assert all(rows[0][field] == "" for field in ks.HORSE_PROFILE_FIELDS + ks.JOCKEY_PROFILE_FIELDS)
+    lookups = ks.crawl_stats.report()["profile_lookups"]
+    assert lookups.get("failed", 0) + lookups.get("fetched", 0) == 2
+    if content.strip() == b"":
+        assert lookups == {"failed": 2}
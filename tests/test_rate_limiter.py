@@ -0,0 +1,26 @@
+# リクエスト間隔の制限（AdaptiveRateLimiter）のテスト
+import threading
+import time
+
+import keiba_scraping as ks
+
+def test_retry_after_blocks_threads_already_waiting(monkeypatch):
+    monkeypatch.setattr(ks.logger, "disabled", True)
+    limiter = ks.AdaptiveRateLimiter(limits={"default": {"rate": 5, "min_rate": 0.05, "max_rate": 5, "burst": 1}},
+                                     jitter=0)
+    start = time.monotonic()
+    limiter.wait("host")
+    sent = []
+
+    def request():
+        limiter.wait("host")
+        sent.append(time.monotonic() - start)
+
+    threads = [threading.Thread(target=request) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05) # 3つのスレッドが予約して待機している間にRetry-Afterを受け取る
+    limiter.record("host", status=503, retry_after=0.5)
+    for thread in threads:
+        thread.join()
+    assert len(sent) == 3 and min(sent) >= 0.5